@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+
+import argparse
+import torch
+import torch.nn as nn
+import numpy as np
+from time import time
+from texttable import Texttable
+from learn import Learn
+from data_loaders.data_loader import import_dataset
+from models.encoders import EncoderCNNGRU, DecoderCNNGRU, DecoderParallel
+from models.ae import VAE
+# Argument Parser
+parser = argparse.ArgumentParser(description='Recurrent vs parallel decoder benchmark')
+# Device Information
+parser.add_argument('--device', type=str, default='cpu', help='device cuda or cpu')
+# Data Parameters
+parser.add_argument('--midi_path', type=str, default='/fast-1/mathieu/datasets', help='path to midi folder')
+parser.add_argument("--dataset", type=str, default="nottingham", help="maestro | nottingham | bach_chorales | combo")
+parser.add_argument('--frame_bar', type=int, default=64, help='put a power of 2 here')
+parser.add_argument('--score_type', type=str, default='mono', help='use mono measures or poly ones')
+parser.add_argument('--score_sig', type=str, default='4_4', help='rhythmic signature to use (use "all" to bypass)')
+parser.add_argument('--data_normalize', type=int, default=1, help='normalize the data')
+parser.add_argument('--data_binarize', type=int, default=1, help='binarize the data')
+parser.add_argument('--data_pitch', type=int, default=1, help='constrain pitches in the data')
+parser.add_argument('--data_export', type=int, default=0, help='recompute the dataset (for debug purposes)')
+parser.add_argument('--data_augment', type=int, default=1, help='use data augmentation')
+parser.add_argument('--data_jobs', type=int, default=1, help='number of processes for the export')
+parser.add_argument('--data_pack', type=int, default=0, help='store and load binarized bars as packed bits')
+parser.add_argument('--data_stream', type=int, default=0, help='stream bars from midi (2 = also fill the cache)')
+parser.add_argument('--data_sparse', type=int, default=0, help='load bars as note events rasterized per batch')
+parser.add_argument('--data_memory', type=int, default=0, help='keep all bars in a shared in-memory tensor')
+parser.add_argument('--data_query', type=str, default='', help='SQL condition on the bar index (uses the all_all export, mono = one pitch over all instruments)')
+parser.add_argument('--data_dedupe', type=int, default=0, help='store identical bars once and sample by multiplicity')
+parser.add_argument('--data_dedupe_power', type=float, default=1., help='power on multiplicities (< 1 flattens)')
+parser.add_argument('--data_classes', type=int, default=1, help='serve uint8 class indices to multi-class models')
+parser.add_argument('--num_classes', type=int, default=2, help='number of velocity classes')
+parser.add_argument('--subsample', type=int, default=0, help='train on subset')
+parser.add_argument('--nbworkers', type=int, default=3, help='')
+parser.add_argument('--output_path', type=str, default='output/', help='major path for data output')
+# Model Parameters
+parser.add_argument("--beta", type=float, default=2., help='value of beta regularization')
+parser.add_argument("--beta_delay", type=int, default=0, help='delay before using beta')
+parser.add_argument('--enc_hidden_size', type=int, default=512, help='do not touch if you do not know')
+parser.add_argument('--dec_hidden_size', type=int, default=512, help='do not touch if you do not know')
+parser.add_argument('--latent_size', type=int, default=64, help='do not touch if you do not know')
+parser.add_argument('--teacher_forcing', type=str, default='scheduled', help='scheduled | full (recurrent decoder in training)')
+# Optimization parameters
+parser.add_argument('--batch_size', type=int, default=64, help='input batch size')
+parser.add_argument('--epochs', type=int, default=5, help='number of epochs to train each model')
+parser.add_argument('--lr', type=float, default=0.0001, help='learning rate')
+parser.add_argument('--nb_generate', type=int, default=20, help='number of batches decoded for the latency')
+parser.add_argument('--seed', type=int, default=1, help='random seed')
+args = parser.parse_args()
+args.device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
+if args.data_binarize and args.num_classes > 1:
+    args.num_classes = 2
+
+
+# Recurrent (cnn-gru) or parallel decoder, on the same encoder
+def build_model(args, encoder_type):
+    args.type_mod = 'normal'
+    args.encoder_type = encoder_type
+    encoder = EncoderCNNGRU(args)
+    args.cnn_size = encoder.cnn_size
+    if encoder_type == 'cnn-gru':
+        decoder = DecoderCNNGRU(args)
+    else:
+        decoder = DecoderParallel(args)
+    return VAE(encoder, decoder, args).float().to(args.device)
+
+
+# Frame-wise accuracy on all the cells and on the active ones (notes)
+def accuracy(model, loader, args):
+    model.eval()
+    correct, total, correct_on, total_on = 0, 0, 0, 0
+    with torch.no_grad():
+        for x in loader:
+            x = loader.dataset.unpack(x.to(args.device))
+            x_recon, _, _ = model(x)
+            x = x.long()
+            if args.num_classes > 1:
+                pred = torch.argmax(x_recon, dim=1)
+            else:
+                pred = (x_recon > .5).long()
+            correct += (pred == x).sum().item()
+            total += x.numel()
+            correct_on += ((pred == x) & (x > 0)).sum().item()
+            total_on += (x > 0).sum().item()
+    return correct / max(total, 1), correct_on / max(total_on, 1)
+
+
+# Bars per second when decoding random latent codes
+def generation_speed(model, args):
+    model.eval()
+    z = torch.randn(args.batch_size, args.latent_size, device=args.device)
+    with torch.no_grad():
+        model.decode(z)
+        time0 = time()
+        for _ in range(args.nb_generate):
+            model.decode(z)
+        if args.device.type == 'cuda':
+            torch.cuda.synchronize()
+    return args.nb_generate * args.batch_size / (time() - time0)
+
+
+print('[Importing dataset]')
+train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args)
+criterion = nn.NLLLoss(reduction='sum') if args.num_classes > 1 else nn.MSELoss()
+results = []
+for encoder_type in ['cnn-gru', 'cnn-parallel']:
+    print('[Training ' + encoder_type + ']')
+    torch.manual_seed(args.seed)
+    np.random.seed(args.seed)
+    model = build_model(args, encoder_type)
+    optimizer = torch.optim.Adam(model.parameters(), lr=args.lr, weight_decay=1e-4)
+    learn = Learn(args, train_loader=train_loader, validate_loader=valid_loader, test_loader=test_loader,
+                  train_set=train_set, validate_set=valid_set, test_set=test_set)
+    train_time = 0
+    for epoch in range(1, args.epochs + 1):
+        time0 = time()
+        learn.train(model, optimizer, criterion, args, epoch)
+        train_time += time() - time0
+    train_speed = args.epochs * len(train_loader) * args.batch_size / train_time
+    acc, acc_on = accuracy(model, test_loader, args)
+    results.append([encoder_type, sum(p.numel() for p in model.decoder.parameters()), train_speed,
+                    generation_speed(model, args), acc, acc_on])
+# Summary
+t = Texttable()
+t.add_rows([['Decoder', 'parameters', 'train (bars/s)', 'generation (bars/s)', 'test accuracy',
+             'test accuracy (notes)']] + results)
+print(t.draw())
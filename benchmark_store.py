@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import argparse
+import numpy as np
+import torch
+from time import time
+from texttable import Texttable
+from data_loaders.data_loader import PianoRollRep
+from data_loaders.bar_store import BarStore, CompressedBarStore, compress_store, store_files, lz4_block
+from data_loaders.bar_store import STORE_NAME, STORE_COMPRESSED
+# Argument Parser
+parser = argparse.ArgumentParser(description='Bar storage benchmark')
+parser.add_argument('--midi_dir', type=str, default='/fast-1/mathieu/datasets/Nottingham/train', help='folder of midi files')
+parser.add_argument('--frame_bar', type=int, default=64, help='put a power of 2 here')
+parser.add_argument('--score_type', type=str, default='all', help='use mono measures or poly ones')
+parser.add_argument('--score_sig', type=str, default='all', help='rhythmic signature to use (use "all" to bypass)')
+parser.add_argument('--chunk_bars', type=int, default=16, help='number of bars in a compressed chunk')
+parser.add_argument('--nb_reads', type=int, default=2000, help='number of random reads')
+parser.add_argument('--tmp_dir', type=str, default='/tmp/bar_benchmark', help='folder for the per-bar files')
+args = parser.parse_args()
+
+
+# Bars per second when reading a list of indices
+def throughput(read, indices):
+    time0 = time()
+    for i in indices:
+        read(i)
+    return len(indices) / (time() - time0)
+
+
+def folder_size(path, names):
+    return sum([os.path.getsize(os.path.join(path, n)) for n in names])
+
+
+# Contiguous store of the bars
+data_set = PianoRollRep(args.midi_dir, args.frame_bar, args.score_type, args.score_sig)
+store = BarStore(data_set.bar_dir)
+raw_size = folder_size(data_set.bar_dir, [os.path.basename(f) for f in store_files(data_set.bar_dir)])
+random_ids = np.random.randint(0, len(store), args.nb_reads)
+sequential_ids = np.arange(min(args.nb_reads, len(store)))
+results = []
+# Per-bar files (former cache format)
+print('[Writing per-bar files]')
+if os.path.exists(args.tmp_dir):
+    shutil.rmtree(args.tmp_dir)
+os.makedirs(args.tmp_dir)
+bar_files = []
+for i in range(len(store)):
+    bar_files.append('per_bar' + str(store.bars[i]) + '_track' + str(store.tracks[i]) + '.pt')
+    torch.save(torch.from_numpy(np.array(store[i])), os.path.join(args.tmp_dir, bar_files[-1]))
+read_pt = lambda i: torch.load(os.path.join(args.tmp_dir, bar_files[i]))
+results.append(['per-bar .pt', folder_size(args.tmp_dir, bar_files), throughput(read_pt, random_ids),
+                throughput(read_pt, sequential_ids)])
+# Raw memory-mapped store
+read_raw = lambda i: torch.from_numpy(np.array(store[i]))
+results.append(['raw store', raw_size, throughput(read_raw, random_ids), throughput(read_raw, sequential_ids)])
+# Compressed stores (chunks decoded into a reused buffer), written from a copy so that the dataset cache is untouched
+store_dir = os.path.join(args.tmp_dir, 'store')
+os.makedirs(store_dir)
+for f in store_files(data_set.bar_dir):
+    shutil.copy(f, store_dir)
+codecs = ['zlib'] + (['lz4'] if lz4_block is not None else [])
+for codec in codecs:
+    compress_store(store_dir, codec=codec, chunk_bars=args.chunk_bars)
+    compressed = CompressedBarStore(store_dir)
+    size = folder_size(store_dir, [os.path.basename(f) for f in store_files(store_dir, STORE_NAME + STORE_COMPRESSED)])
+    read_z = lambda i: torch.from_numpy(np.array(compressed[i]))
+    results.append([codec + ' (' + str(args.chunk_bars) + ' bars)', size, throughput(read_z, random_ids),
+                    throughput(read_z, sequential_ids)])
+shutil.rmtree(args.tmp_dir)
+# Summary
+print('[%d bars of shape %s]' % (len(store), str(store.bar_shape)))
+t = Texttable()
+t.add_rows([['Format', 'size (MB)', 'random (bars/s)', 'sequential (bars/s)']] +
+           [[r[0], r[1] / 2 ** 20, r[2], r[3]] for r in results])
+print(t.draw())
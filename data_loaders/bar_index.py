@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+
+import os
+import sqlite3
+import numpy as np
+from .bar_store import open_store, STORE_NAME
+from .midi_header import midi_index
+
+# Per-bar metadata of a store, as an SQLite database
+INDEX_NAME = 'meta.sqlite'
+INDEX_COLUMNS = ['idx INTEGER PRIMARY KEY', 'file TEXT', 'track INTEGER', 'bar INTEGER', 'ts_num INTEGER',
+                 'ts_den INTEGER', 'tempo REAL', 'polyphony INTEGER', 'pitch_min INTEGER', 'pitch_max INTEGER',
+                 'nb_notes INTEGER']
+INDEX_FIELDS = [c.split()[0] for c in INDEX_COLUMNS]
+
+
+def index_path(store_dir, name=STORE_NAME):
+    return os.path.join(store_dir, name + '_' + INDEX_NAME)
+
+
+def index_fingerprint(store_dir, name=STORE_NAME):
+    path = index_path(store_dir, name)
+    if not os.path.exists(path):
+        return None
+    db = sqlite3.connect(path)
+    try:
+        return db.execute('SELECT fingerprint FROM info').fetchone()[0]
+    except sqlite3.Error:
+        return None
+    finally:
+        db.close()
+
+
+# Descriptors of a chunk of bars [N, P, T]
+def bar_descriptors(x):
+    active = x > 0
+    # Maximum number of simultaneous pitches
+    polyphony = active.sum(axis=1).max(axis=1)
+    pitch_on = active.any(axis=2)
+    empty = ~pitch_on.any(axis=1)
+    pitch_min = np.argmax(pitch_on, axis=1)
+    pitch_max = pitch_on.shape[1] - 1 - np.argmax(pitch_on[:, ::-1], axis=1)
+    # Notes are counted from their onsets (cells active after an inactive one)
+    onsets = active.copy()
+    onsets[:, :, 1:] &= ~active[:, :, :-1]
+    nb_notes = onsets.sum(axis=(1, 2))
+    return polyphony, np.where(empty, -1, pitch_min), np.where(empty, -1, pitch_max), nb_notes
+
+
+def build_bar_index(store_dir, root_dir, name=STORE_NAME, chunk=1024):
+    """
+    Create (or refresh) the metadata index of a store. Each bar records its file,
+    track and position, the time signature and tempo of its file, its polyphony,
+    its pitch range (-1 for empty bars) and its number of notes. The index is only
+    rebuilt when the store fingerprint changes.
+    """
+    store = open_store(store_dir, name)
+    if store.fingerprint is not None and index_fingerprint(store_dir, name) == store.fingerprint:
+        return
+    headers = midi_index(root_dir, store.files)
+    path = index_path(store_dir, name)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    db.execute('CREATE TABLE bars (' + ', '.join(INDEX_COLUMNS) + ')')
+    db.execute('CREATE TABLE info (fingerprint TEXT)')
+    db.execute('INSERT INTO info VALUES (?)', (store.fingerprint,))
+    for start in range(0, len(store), chunk):
+        x = np.asarray(store.data[start:start + chunk])
+        polyphony, pitch_min, pitch_max, nb_notes = bar_descriptors(x)
+        rows = []
+        for i in range(x.shape[0]):
+            track = int(store.tracks[start + i])
+            file_name = store.files[track]
+            header = headers[file_name]['header'] or {'sig': None, 'tempo': None}
+            sig = header['sig'] or [None, None]
+            rows.append((start + i, file_name, track, int(store.bars[start + i]), sig[0], sig[1], header['tempo'],
+                         int(polyphony[i]), int(pitch_min[i]), int(pitch_max[i]), int(nb_notes[i])))
+        db.executemany('INSERT INTO bars VALUES (' + ', '.join(['?'] * len(INDEX_COLUMNS)) + ')', rows)
+    db.commit()
+    db.close()
+    os.replace(tmp_path, path)
+
+
+# Queries may only read the columns of the bar index (and call SQL functions)
+def authorize_query(action, arg1, arg2, db_name, source):
+    if action in [sqlite3.SQLITE_SELECT, sqlite3.SQLITE_FUNCTION]:
+        return sqlite3.SQLITE_OK
+    # (rows read without any column, as in full scans, come with an empty column name)
+    if action == sqlite3.SQLITE_READ and arg1 == 'bars' and arg2 in INDEX_FIELDS + ['']:
+        return sqlite3.SQLITE_OK
+    return sqlite3.SQLITE_DENY
+
+
+def query_bars(store_dir, where, name=STORE_NAME):
+    """
+    The condition is parsed by SQLite on a read-only connection, where it is only
+    authorized to read the columns of the index (INDEX_FIELDS).
+
+    Args:
+        where (str): SQL condition on the columns of the index (e.g. 'polyphony = 1')
+    Returns:
+        list: indices of the matching bars in the store (in store order).
+    Raises:
+        ValueError: if the condition is invalid or uses anything else than the index columns.
+    """
+    db = sqlite3.connect('file:' + index_path(store_dir, name) + '?mode=ro', uri=True)
+    db.set_authorizer(authorize_query)
+    try:
+        return [r[0] for r in db.execute('SELECT idx FROM bars WHERE ' + where + ' ORDER BY idx')]
+    except sqlite3.DatabaseError as e:
+        raise ValueError('invalid bar query "%s" (%s), columns are %s' % (where, e, ', '.join(INDEX_FIELDS)))
+    finally:
+        db.close()
+
+
+# Condition approximating a score_type / score_sig selection on the all_all store. The polyphony is the one of
+# the merged roll of all instruments, so mono keeps bars where the whole track plays one pitch at a time (silent
+# bars excluded). This is not the mono export: mono_bars takes a bar from any instrument that is monophonic in
+# it, which also selects bars of multi-instrument tracks that are polyphonic once merged.
+def subset_query(score_type='all', score_sig='all'):
+    conditions = []
+    if score_type == 'mono':
+        conditions.append('polyphony = 1')
+    if score_sig != 'all':
+        sig_n, sig_d = [int(s) for s in score_sig.split('_')]
+        conditions.append('(ts_num IS NULL OR (ts_num = %d AND ts_den = %d))' % (sig_n, sig_d))
+    return ' AND '.join(conditions) if len(conditions) > 0 else '1'
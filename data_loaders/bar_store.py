@@ -0,0 +1,634 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import zlib
+import hashlib
+import numpy as np
+import torch
+try:
+    import lz4.block as lz4_block
+except ImportError:
+    lz4_block = None
+
+# Stores kept inside a piano_roll_bar_* directory (raw velocities and bit-packed)
+STORE_NAME = 'bars'
+STORE_PACKED = 'bars_packed'
+STORE_EVENTS = 'bars_events'
+STORE_UNIQUE = 'bars_unique'
+STORE_MANIFEST = 'manifest.json'
+STORE_PARTIALS = 'partial'
+STORE_COMPRESSED = '_z'
+STORE_VERSION = 1
+
+
+# Files composing a store: data, index and header
+def store_files(store_dir, name=STORE_NAME):
+    return (os.path.join(store_dir, name + '.dat'), os.path.join(store_dir, name + '_index.npz'),
+            os.path.join(store_dir, name + '.json'))
+
+
+# -----------------------------------------------------------
+#
+# Contiguous bar store (writer)
+#
+# -----------------------------------------------------------
+
+class BarStoreWriter(object):
+    """
+    Pack all the bars of a split into a single contiguous array file.
+
+    Bars are appended track by track, so that the store keeps the order of the
+    exported MIDI files. The index records for each bar its track (position in
+    the list of files) and its bar number inside the track.
+
+    Args:
+        store_dir (str): directory that will hold the store files
+        bar_shape (tuple): shape of a single bar (pitch, frames)
+        dtype (str): numpy type used to store the bars. default: 'float32'
+        name (str): name of the store inside the directory. default: 'bars'
+    """
+
+    def __init__(self, store_dir, bar_shape, dtype='float32', name=STORE_NAME):
+        self.store_dir = store_dir
+        self.data_path, self.index_path, self.header_path = store_files(store_dir, name)
+        self.bar_shape = tuple(int(s) for s in bar_shape)
+        self.dtype = np.dtype(dtype)
+        self.files = []
+        self.tracks = []
+        self.bars = []
+        # Fingerprint of the content (bars, positions and files)
+        self.md5 = hashlib.md5()
+        # (temporary files are named after the process, as several exports may share the directory)
+        self.tmp_path = self.data_path + '.%d.tmp' % os.getpid()
+        self.data = open(self.tmp_path, 'wb')
+
+    def add_track(self, file_name, bars, bar_ids):
+        """
+        Args:
+            file_name (str): name of the source MIDI file
+            bars (list): piano-roll bars (arrays of shape bar_shape)
+            bar_ids (list): position of each bar inside the track
+        """
+        track = len(self.files)
+        self.files.append(str(file_name))
+        for bar, bar_id in zip(bars, bar_ids):
+            bar = np.ascontiguousarray(bar, dtype=self.dtype)
+            if bar.shape != self.bar_shape:
+                raise ValueError('Bar of shape %s does not fit store of shape %s' % (bar.shape, self.bar_shape))
+            self.data.write(bar.tobytes())
+            self.md5.update(bar.tobytes())
+            self.tracks.append(track)
+            self.bars.append(int(bar_id))
+        return track
+
+    def close(self):
+        """ Finalize the store (all files are written aside, then renamed with the header last) """
+        self.data.close()
+        tracks, bars = np.array(self.tracks, dtype=np.int32), np.array(self.bars, dtype=np.int32)
+        index_tmp, header_tmp = self.index_path + '.%d.tmp' % os.getpid(), self.header_path + '.%d.tmp' % os.getpid()
+        with open(index_tmp, 'wb') as f:
+            np.savez(f, track=tracks, bar=bars)
+        for info in [tracks.tobytes(), bars.tobytes(), json.dumps(self.files).encode()]:
+            self.md5.update(info)
+        header = {'version': STORE_VERSION,
+                  'count': len(self.tracks),
+                  'bar_shape': list(self.bar_shape),
+                  'dtype': self.dtype.name,
+                  'fingerprint': self.md5.hexdigest(),
+                  'files': self.files}
+        with open(header_tmp, 'w') as f:
+            json.dump(header, f)
+        os.replace(self.tmp_path, self.data_path)
+        os.replace(index_tmp, self.index_path)
+        os.replace(header_tmp, self.header_path)
+
+
+# -----------------------------------------------------------
+#
+# Contiguous bar store (reader)
+#
+# -----------------------------------------------------------
+
+class BarStore(object):
+    """
+    Read-only access to a bar store through a numpy memory map.
+
+    The map is opened lazily (and dropped when pickled), so that every
+    DataLoader worker maps the same file and shares the OS page cache,
+    instead of deserializing its own copy of the data.
+
+    Args:
+        store_dir (str): directory holding the store files
+        name (str): name of the store inside the directory. default: 'bars'
+    """
+
+    def __init__(self, store_dir, name=STORE_NAME):
+        self.store_dir = store_dir
+        self.name = name
+        self.data_path, index_path, header_path = store_files(store_dir, name)
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        self.count = header['count']
+        self.bar_shape = tuple(header['bar_shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.fingerprint = header.get('fingerprint')
+        self.files = header['files']
+        index = np.load(index_path)
+        self.tracks = index['track']
+        self.bars = index['bar']
+        self._data = None
+
+    @staticmethod
+    def exists(store_dir, name=STORE_NAME):
+        return os.path.exists(store_files(store_dir, name)[2])
+
+    @property
+    def data(self):
+        if self._data is None:
+            if self.count == 0:
+                self._data = np.zeros((0,) + self.bar_shape, dtype=self.dtype)
+            else:
+                # Copy-on-write map: slices are zero-copy views, in-place edits never reach the disk
+                self._data = np.memmap(self.data_path, dtype=self.dtype, mode='c',
+                                       shape=(self.count,) + self.bar_shape)
+        return self._data
+
+    def track_bars(self, track):
+        """ Bars (and their positions) of one track, which are contiguous in the store """
+        start, end = np.searchsorted(self.tracks, [track, track + 1])
+        return self.data[start:end], self.bars[start:end]
+
+    def stats(self, chunk=1024):
+        """
+        Statistics of the store in a single vectorized pass over chunks of bars.
+        They are saved in a sidecar file, which is reused as long as the store
+        fingerprint does not change.
+        Returns:
+            dict: min, max, value counts, active pitches, mono and poly bar counts
+        """
+        path = os.path.join(self.store_dir, self.name + '_stats.json')
+        if self.fingerprint is not None and os.path.exists(path):
+            with open(path, 'r') as f:
+                stats = json.load(f)
+            if stats['fingerprint'] == self.fingerprint:
+                return stats
+        max_v, min_v, counts = None, None, {}
+        pitch_on = np.zeros(self.bar_shape[0], dtype=bool)
+        count_poly = 0
+        for start in range(0, self.count, chunk):
+            x = np.asarray(self.data[start:start + chunk])
+            max_v = max(float(x.max()), max_v if max_v is not None else -np.inf)
+            min_v = min(float(x.min()), min_v if min_v is not None else np.inf)
+            values, value_counts = np.unique(x, return_counts=True)
+            for v, c in zip(values.tolist(), value_counts.tolist()):
+                counts[v] = counts.get(v, 0) + c
+            active = x > 0
+            pitch_on |= active.any(axis=(0, 2))
+            count_poly += int((active.sum(axis=1) > 1).any(axis=1).sum())
+        stats = {'fingerprint': self.fingerprint,
+                 'min': min_v, 'max': max_v,
+                 'counts': [[v, c] for v, c in sorted(counts.items())],
+                 'pitch_on': np.nonzero(pitch_on)[0].tolist(),
+                 'poly': count_poly, 'mono': self.count - count_poly}
+        if self.fingerprint is not None:
+            # Written aside then renamed, so that a killed or concurrent run never leaves a partial sidecar
+            tmp_path = path + '.%d.tmp' % os.getpid()
+            with open(tmp_path, 'w') as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, path)
+        return stats
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.data[index]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_data'] = None
+        return state
+
+
+# -----------------------------------------------------------
+#
+# Compressed storage (chunks of bars, for archival and transfers)
+#
+# -----------------------------------------------------------
+
+def compress_bytes(raw, codec='zlib', level=6):
+    if codec == 'lz4':
+        if lz4_block is None:
+            raise ImportError('The lz4 codec requires the lz4 package')
+        return lz4_block.compress(raw)
+    return zlib.compress(raw, level)
+
+
+def decompress_bytes(block, codec='zlib'):
+    if codec == 'lz4':
+        if lz4_block is None:
+            raise ImportError('The lz4 codec requires the lz4 package')
+        return lz4_block.decompress(block)
+    return zlib.decompress(block)
+
+
+def compress_store(store_dir, name=STORE_NAME, codec='zlib', chunk_bars=16, level=6):
+    """
+    Write a compressed copy of a store: bars are grouped in chunks of chunk_bars,
+    each compressed on its own so that random access only decodes one chunk.
+
+    Args:
+        codec (str): 'zlib' (standard library) or 'lz4' (optional, faster). default: 'zlib'
+        chunk_bars (int): number of bars in a chunk. default: 16
+    """
+    store = BarStore(store_dir, name)
+    data_path, index_path, header_path = store_files(store_dir, name + STORE_COMPRESSED)
+    offsets = [0]
+    tmp_path = data_path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for start in range(0, store.count, chunk_bars):
+            block = compress_bytes(np.ascontiguousarray(store.data[start:start + chunk_bars]).tobytes(), codec, level)
+            f.write(block)
+            offsets.append(offsets[-1] + len(block))
+    os.replace(tmp_path, data_path)
+    np.savez(index_path, track=store.tracks, bar=store.bars)
+    with open(header_path, 'w') as f:
+        json.dump({'version': STORE_VERSION, 'count': store.count, 'bar_shape': list(store.bar_shape),
+                   'dtype': store.dtype.str, 'fingerprint': store.fingerprint, 'files': store.files,
+                   'codec': codec, 'chunk_bars': chunk_bars, 'offsets': offsets}, f)
+
+
+class CompressedBarStore(BarStore):
+    """
+    Read-only access to a compressed store, with the same interface as BarStore.
+
+    A chunk is decompressed into a buffer that is reused by the process (each
+    DataLoader worker keeps its own), so that the following bars of the same chunk
+    are served without decoding it again. Returned arrays are views of this buffer,
+    valid until the next access.
+
+    Args:
+        store_dir (str): directory holding the store files
+        name (str): name of the (uncompressed) store. default: 'bars'
+    """
+
+    def __init__(self, store_dir, name=STORE_NAME):
+        self.store_dir = store_dir
+        self.name = name
+        self.data_path, index_path, header_path = store_files(store_dir, name + STORE_COMPRESSED)
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        self.count = header['count']
+        self.bar_shape = tuple(header['bar_shape'])
+        self.dtype = np.dtype(header['dtype'])
+        self.fingerprint = header.get('fingerprint')
+        self.files = header['files']
+        self.codec = header['codec']
+        self.chunk_bars = header['chunk_bars']
+        self.offsets = np.array(header['offsets'], dtype=np.int64)
+        index = np.load(index_path)
+        self.tracks = index['track']
+        self.bars = index['bar']
+        self._file = None
+        self._buffer = None
+        self._chunk = -1
+
+    @staticmethod
+    def exists(store_dir, name=STORE_NAME):
+        return os.path.exists(store_files(store_dir, name + STORE_COMPRESSED)[2])
+
+    @property
+    def data(self):
+        # Slices of the store are decoded on demand
+        return self
+
+    def read_chunk(self, chunk):
+        n_bars = min(self.chunk_bars, self.count - chunk * self.chunk_bars)
+        if chunk != self._chunk:
+            if self._file is None:
+                self._file = open(self.data_path, 'rb')
+                self._buffer = np.empty((self.chunk_bars,) + self.bar_shape, dtype=self.dtype)
+            self._file.seek(self.offsets[chunk])
+            block = self._file.read(self.offsets[chunk + 1] - self.offsets[chunk])
+            raw = decompress_bytes(block, self.codec)
+            self._buffer[:n_bars] = np.frombuffer(raw, dtype=self.dtype).reshape((n_bars,) + self.bar_shape)
+            self._chunk = chunk
+        return self._buffer[:n_bars]
+
+    def __getitem__(self, index):
+        rest = ()
+        if isinstance(index, tuple):
+            index, rest = index[0], index[1:]
+        if isinstance(index, slice):
+            start, stop, _ = index.indices(self.count)
+            chunks = range(start // self.chunk_bars, (stop + self.chunk_bars - 1) // self.chunk_bars)
+            if len(chunks) == 1:
+                # A single chunk is returned as a view of the buffer
+                first = chunks[0] * self.chunk_bars
+                return self.read_chunk(chunks[0])[start - first:stop - first][(slice(None),) + rest]
+            output = np.zeros((max(stop - start, 0),) + self.bar_shape, dtype=self.dtype)
+            for chunk in chunks:
+                first = chunk * self.chunk_bars
+                bars = self.read_chunk(chunk)[max(start - first, 0):stop - first]
+                output[max(first - start, 0):max(first - start, 0) + bars.shape[0]] = bars
+            return output[(slice(None),) + rest]
+        index = int(index) % self.count
+        return self.read_chunk(index // self.chunk_bars)[index % self.chunk_bars][rest]
+
+    def track_bars(self, track):
+        # Copied, as views of the buffer do not outlive the next access
+        bars, bar_ids = super(CompressedBarStore, self).track_bars(track)
+        return np.array(bars), bar_ids
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_file'], state['_buffer'], state['_chunk'] = None, None, -1
+        return state
+
+
+def store_exists(store_dir, name=STORE_NAME):
+    return BarStore.exists(store_dir, name) or CompressedBarStore.exists(store_dir, name)
+
+
+def open_store(store_dir, name=STORE_NAME):
+    """ Open a store, from its raw version if available and from its compressed one otherwise """
+    if BarStore.exists(store_dir, name):
+        return BarStore(store_dir, name)
+    return CompressedBarStore(store_dir, name)
+
+
+# -----------------------------------------------------------
+#
+# Bit-packed storage of binarized bars
+#
+# -----------------------------------------------------------
+
+def pack_store(store_dir, source=STORE_NAME, name=STORE_PACKED):
+    """ Derive a bit-packed copy of a store (active cells become bits, 8 frames per byte) """
+    store = open_store(store_dir, source)
+    n_bytes = (store.bar_shape[1] + 7) // 8
+    writer = BarStoreWriter(store_dir, (store.bar_shape[0], n_bytes), 'uint8', name)
+    for track, file_name in enumerate(store.files):
+        bars, bar_ids = store.track_bars(track)
+        writer.add_track(file_name, np.packbits(bars > 0, axis=-1), bar_ids)
+    writer.close()
+
+
+def unpack_bits(x, n_frames, dtype=torch.float):
+    """
+    Args:
+        x (Tensor): uint8 tensor of shape [..., ceil(T / 8)] (on any device)
+        n_frames (int): number of frames T to recover
+        dtype (torch.dtype): type of the output (uint8 gives class indices). default: float
+    Returns:
+        Tensor: piano-rolls of shape [..., T]
+    """
+    shifts = torch.arange(7, -1, -1, dtype=torch.uint8, device=x.device)
+    bits = (x.unsqueeze(-1) >> shifts) & 1
+    return bits.view(*x.shape[:-1], -1)[..., :n_frames].to(dtype)
+
+
+# -----------------------------------------------------------
+#
+# Deduplicated storage (distinct bars and their multiplicity)
+#
+# -----------------------------------------------------------
+
+def unique_store(store_dir, source=STORE_NAME, name=STORE_UNIQUE):
+    """
+    Derive a store holding each distinct bar of a source store once (at its first
+    occurrence, so that tracks stay contiguous), along with the number of copies of
+    each unique bar and the unique bar of each source bar. Rebuilt whenever the
+    source fingerprint changes.
+    """
+    store = open_store(store_dir, source)
+    counts_path = os.path.join(store_dir, name + '_counts.npz')
+    if BarStore.exists(store_dir, name) and os.path.exists(counts_path):
+        if store.fingerprint is not None and str(np.load(counts_path)['source']) == store.fingerprint:
+            return
+    writer = BarStoreWriter(store_dir, store.bar_shape, store.dtype, name)
+    seen, inverse = {}, np.zeros(store.count, dtype=np.int64)
+    for track, file_name in enumerate(store.files):
+        bars, bar_ids = store.track_bars(track)
+        start = np.searchsorted(store.tracks, track)
+        first = []
+        for i in range(len(bar_ids)):
+            key = hashlib.md5(np.ascontiguousarray(bars[i]).tobytes()).digest()
+            if key not in seen:
+                seen[key] = len(seen)
+                first.append(i)
+            inverse[start + i] = seen[key]
+        writer.add_track(file_name, bars[first], bar_ids[first])
+    writer.close()
+    np.savez(counts_path, counts=np.bincount(inverse, minlength=len(seen)), inverse=inverse,
+             source=str(store.fingerprint))
+    # Keep the bit-packed version in sync
+    if BarStore.exists(store_dir, name + '_packed'):
+        pack_store(store_dir, name, name + '_packed')
+
+
+def load_unique_counts(store_dir, name=STORE_UNIQUE):
+    """
+    Returns:
+        Numpy array: number of copies of each unique bar
+        Numpy array: index of the unique bar of each bar of the source store
+    """
+    data = np.load(os.path.join(store_dir, name + '_counts.npz'))
+    return data['counts'], data['inverse']
+
+
+# -----------------------------------------------------------
+#
+# Sparse note-event storage
+#
+# -----------------------------------------------------------
+
+def bars_to_events(x):
+    """
+    Turn dense bars into note events (maximal runs of a constant velocity).
+
+    Args:
+        x (Numpy array): bars of shape [n, pitch, frames]
+    Returns:
+        Numpy array: int16 events (pitch, onset, offset, velocity) of shape [E, 4]
+        Numpy array: number of events of each bar
+    """
+    prev = np.concatenate([np.zeros_like(x[..., :1]), x[..., :-1]], axis=-1)
+    nxt = np.concatenate([x[..., 1:], np.zeros_like(x[..., :1])], axis=-1)
+    # Runs inside a row are ordered, so starts and ends pair up in C order
+    bar, pitch, onset = np.nonzero((x != 0) & (x != prev))
+    offset = np.nonzero((x != 0) & (x != nxt))[2] + 1
+    velocity = x[bar, pitch, onset]
+    if velocity.size > 0 and np.abs(velocity).max() > np.iinfo(np.int16).max:
+        raise ValueError('Velocities do not fit in the event store')
+    events = np.stack([pitch, onset, offset, np.round(velocity)], axis=1).astype(np.int16)
+    return events, np.bincount(bar, minlength=x.shape[0])
+
+
+def events_store(store_dir, source=STORE_NAME, name=STORE_EVENTS, chunk=1024):
+    """ Derive the event version of a store (rebuilt whenever the source fingerprint changes) """
+    store = open_store(store_dir, source)
+    header_path = os.path.join(store_dir, name + '.json')
+    if os.path.exists(header_path):
+        with open(header_path, 'r') as f:
+            header = json.load(f)
+        if store.fingerprint is not None and header['source'] == store.fingerprint:
+            return
+    events, counts = [np.zeros((0, 4), dtype=np.int16)], [np.zeros(0, dtype=np.int64)]
+    for start in range(0, store.count, chunk):
+        cur_events, cur_counts = bars_to_events(np.asarray(store.data[start:start + chunk]))
+        events.append(cur_events)
+        counts.append(cur_counts)
+    offsets = np.concatenate([[0], np.cumsum(np.concatenate(counts))]).astype(np.int64)
+    np.save(os.path.join(store_dir, name + '.npy'), np.concatenate(events))
+    np.save(os.path.join(store_dir, name + '_offsets.npy'), offsets)
+    with open(header_path, 'w') as f:
+        json.dump({'source': store.fingerprint, 'count': store.count, 'bar_shape': list(store.bar_shape)}, f)
+
+
+class EventStore(object):
+    """
+    Read-only access to the events of each bar (memory-mapped, opened lazily).
+
+    Args:
+        store_dir (str): directory holding the store files
+        name (str): name of the event store. default: 'bars_events'
+    """
+
+    def __init__(self, store_dir, name=STORE_EVENTS):
+        self.events_path = os.path.join(store_dir, name + '.npy')
+        with open(os.path.join(store_dir, name + '.json'), 'r') as f:
+            header = json.load(f)
+        self.count = header['count']
+        self.bar_shape = tuple(header['bar_shape'])
+        self.offsets = np.load(os.path.join(store_dir, name + '_offsets.npy'))
+        self._events = None
+
+    @property
+    def events(self):
+        if self._events is None:
+            self._events = np.load(self.events_path, mmap_mode='r')
+        return self._events
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, index):
+        return self.events[self.offsets[index]:self.offsets[index + 1]]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_events'] = None
+        return state
+
+
+def rasterize_events(events, n_frames, min_p=0, max_p=128):
+    """
+    Rasterize a batch of bars in one vectorized scatter and cumulative sum.
+
+    Args:
+        events (list): int16 tensors of events (pitch, onset, offset, velocity), one per bar
+        n_frames (int): number of frames of a bar
+        min_p (int): lowest pitch kept in the piano-roll
+        max_p (int): highest pitch kept in the piano-roll
+    Returns:
+        Tensor: float piano-rolls of shape [B, pitch, n_frames]
+    """
+    n_pitch = min(max_p + 1, 128) - min_p
+    sizes = torch.tensor([e.shape[0] for e in events], dtype=torch.long)
+    items = torch.repeat_interleave(torch.arange(len(events)), sizes)
+    events = torch.cat(list(events)).long() if len(events) > 0 else torch.zeros(0, 4, dtype=torch.long)
+    # Only keep events inside the pitch range
+    keep = (events[:, 0] >= min_p) & (events[:, 0] < min_p + n_pitch)
+    events, items = events[keep], items[keep]
+    pitch, velocity = events[:, 0] - min_p, events[:, 3].float()
+    roll = torch.zeros(len(sizes), n_pitch, n_frames + 1)
+    roll.index_put_((items, pitch, events[:, 1]), velocity, accumulate=True)
+    roll.index_put_((items, pitch, events[:, 2]), -velocity, accumulate=True)
+    return roll.cumsum(2)[:, :, :n_frames]
+
+
+# -----------------------------------------------------------
+#
+# Export manifest (content hash of each source file)
+#
+# -----------------------------------------------------------
+
+def file_hash(path, block_size=1 << 20):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+
+def hash_files(root_dir, file_names, manifest=None):
+    """
+    Content hash of the source files. Hashes recorded in a previous manifest
+    are reused when the size and modification time of a file did not change.
+    """
+    previous = manifest['files'] if manifest is not None else {}
+    entries = {}
+    for file_name in file_names:
+        stat = os.stat(os.path.join(root_dir, file_name))
+        entry = previous.get(file_name)
+        if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+            entry = {'hash': file_hash(os.path.join(root_dir, file_name))}
+        entries[file_name] = {'hash': entry['hash'], 'size': stat.st_size, 'mtime': stat.st_mtime}
+    return entries
+
+
+def load_manifest(store_dir):
+    path = os.path.join(store_dir, STORE_MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def save_manifest(store_dir, params, entries):
+    # Written aside then renamed: a partial manifest could mark files as exported
+    path = os.path.join(store_dir, STORE_MANIFEST)
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump({'params': params, 'files': entries}, f)
+    os.replace(tmp_path, path)
+
+
+# -----------------------------------------------------------
+#
+# Per-file partial exports (written through by the streaming dataset)
+#
+# -----------------------------------------------------------
+
+def partial_path(store_dir, content_hash):
+    return os.path.join(store_dir, STORE_PARTIALS, content_hash + '.npz')
+
+
+def save_partial(store_dir, content_hash, bars, bar_ids, bar_shape):
+    """ Save the bars of one source file, keyed by its content hash """
+    os.makedirs(os.path.join(store_dir, STORE_PARTIALS), exist_ok=True)
+    path = partial_path(store_dir, content_hash)
+    bars = np.array(bars, dtype=np.float32).reshape((len(bar_ids),) + tuple(bar_shape))
+    # Write to a temporary file first, as several workers may share the directory
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, bars=bars, bar_ids=np.array(bar_ids, dtype=np.int32))
+    os.replace(tmp_path, path)
+
+
+def load_partial(store_dir, content_hash):
+    path = partial_path(store_dir, content_hash)
+    if not os.path.exists(path):
+        return None
+    data = np.load(path)
+    return data['bars'], data['bar_ids']
+
+
+def clear_partials(store_dir):
+    path = os.path.join(store_dir, STORE_PARTIALS)
+    if os.path.exists(path):
+        for file_name in os.listdir(path):
+            os.remove(os.path.join(path, file_name))
+        os.rmdir(path)
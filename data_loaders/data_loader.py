@@ -4,21 +4,34 @@ import torch
 from torch.utils.data.dataset import Dataset
 from torch import nn
 import os
+import json
+import hashlib
 import numpy as np
 import math
+from functools import partial
 import pretty_midi
 from statistics import mean
-from torch.utils.data.sampler import SubsetRandomSampler
-from torch.utils.data import Dataset
-import torchvision.transforms as transform
+from torch.utils.data.sampler import SubsetRandomSampler, WeightedRandomSampler
+from torch.utils.data import Dataset, IterableDataset
+from torch.utils.data.dataloader import default_collate
 from torchvision.transforms import functional
 from .transforms import Transpose, MaskColumns, MaskRows, PitchFlip, TimeFlip
+from .transforms import BatchAugment, BatchTranspose, BatchMaskRows, BatchTimeFlip, BatchPitchFlip
+from .bar_store import BarStore, BarStoreWriter, STORE_VERSION, STORE_PACKED, hash_files, load_manifest, save_manifest
+from .bar_store import pack_store, unpack_bits, file_hash, partial_path
+from .bar_store import save_partial, load_partial, clear_partials, EventStore, events_store, rasterize_events
+from .bar_store import STORE_NAME, STORE_UNIQUE, unique_store, load_unique_counts
+from .bar_store import CompressedBarStore, compress_store, open_store, store_exists
+from .downbeats import track_downbeats, prefetch_downbeats, METALIGN_TIMEOUT
+from .midi_header import midi_index, scan_midi, signature_match
+from .bar_index import build_bar_index, query_bars, subset_query
 #from guppy import hpy
 import argparse
 from idlelib.pyparse import trans
 import random
 import matplotlib.pyplot as plt
-import subprocess
+import multiprocessing
+from tqdm import tqdm
 
 
 def maximum(train_set, valid_set, test_set):
@@ -43,25 +56,77 @@ def maximum(train_set, valid_set, test_set):
     return max_global, track_train, track_valid, track_test
 
 
-# Main data import
-def import_dataset(args):
-    base_path = args.midi_path
+# Folder of the midi files of a dataset
+def dataset_path(args):
+    folder_str = {'maestro': 'maestro_folders', 'nottingham': 'Nottingham', 'bach_chorales': 'JSB_Chorales', 'combo':'poly_combo'}
+    return args.midi_path + '/' + folder_str[args.dataset]
+
+
+# Directory holding the exported bars of a variant
+def bar_path(root_dir, frame_bar, score_type, score_sig):
+    return root_dir + "/piano_roll_bar_" + str(frame_bar) + '_' + score_type + '_' + score_sig
+
+
+# Parameters that the exported bars depend on
+def export_params(frame_bar, score_type, score_sig):
+    return {'version': STORE_VERSION, 'frame_bar': frame_bar, 'score_type': score_type, 'score_sig': score_sig}
+
+
+# Fingerprint of the data seen by a model (content of the stores, processing and bars selected in each split)
+def data_fingerprint(data_sets, indices=None):
+    manifests = [cur_set.manifest() for cur_set in data_sets]
+    md5 = hashlib.md5(json.dumps(manifests, sort_keys=True).encode())
+    for cur_indices in (indices or []):
+        cur_indices = np.asarray(cur_indices, dtype=np.int64)
+        md5.update(str(len(cur_indices)).encode())
+        md5.update(cur_indices.tobytes())
+    return md5.hexdigest()
+
+
+# Main data import (restored from a data snapshot when one matching the arguments exists)
+def import_dataset(args, snapshot=None):
+    if snapshot is not None and os.path.exists(snapshot) and not args.data_export:
+        data_snapshot = DataSnapshot.load(snapshot)
+        if data_snapshot.matches(args):
+            try:
+                return data_snapshot.restore(args)
+            except ValueError as e:
+                print('[Data snapshot is outdated: %s]' % e)
     # Main transform
     # transform = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=2.342, std=12.476)])  # Rescale?
-    folder_str = {'maestro': 'maestro_folders', 'nottingham': 'Nottingham', 'bach_chorales': 'JSB_Chorales', 'combo':'poly_combo'}
-    base_path += '/' + folder_str[args.dataset]
+    base_path = dataset_path(args)
     # Retrieve correct data loader
     if args.dataset in ["maestro", "nottingham", "bach_chorales", "combo"]:
         train_path = base_path + "/train"
         test_path = base_path + "/test"
         valid_path = base_path + "/valid"
         # Import each of the set
-        train_set = PianoRollRep(train_path, args.frame_bar, args.score_type, args.score_sig, args.data_binarize,
-                                 args.data_augment, args.data_export)
-        test_set = PianoRollRep(test_path, args.frame_bar, args.score_type, args.score_sig, args.data_binarize,
-                                args.data_augment, args.data_export, False)
-        valid_set = PianoRollRep(valid_path, args.frame_bar, args.score_type, args.score_sig, args.data_binarize,
-                                 args.data_augment, args.data_export, False)
+        if args.data_stream:
+            # Stream bars straight from the midi files (no normalization statistics available)
+            train_set, valid_set, test_set = [PianoRollStream(path, args.frame_bar, args.score_type, args.score_sig,
+                                                              args.data_binarize, args.data_augment, training,
+                                                              write_through=args.data_stream > 1)
+                                              for path, training in [(train_path, True), (valid_path, False),
+                                                                     (test_path, False)]]
+            for cur_set in [train_set, valid_set, test_set]:
+                cur_set.classes = bool(args.data_classes and args.num_classes > 1)
+            return stream_loaders(train_set, valid_set, test_set, args)
+        # Dense bars or sparse note events (or windows of several bars)
+        dataset = PianoRollEvents if args.data_sparse else PianoRollRep
+        # (no model consumes windows yet, so the training scripts do not expose --data_window)
+        if getattr(args, 'data_window', 1) > 1:
+            dataset = partial(PianoRollWindows, window=args.data_window)
+        # Subsets are selected from the metadata index of the full export
+        score_type, score_sig = ['all', 'all'] if args.data_query else [args.score_type, args.score_sig]
+        train_set = dataset(train_path, args.frame_bar, score_type, score_sig, args.data_binarize,
+                            args.data_augment, args.data_export, nb_jobs=args.data_jobs, pack=args.data_pack,
+                            dedupe=args.data_dedupe)
+        test_set = dataset(test_path, args.frame_bar, score_type, score_sig, args.data_binarize,
+                           args.data_augment, args.data_export, False, nb_jobs=args.data_jobs, pack=args.data_pack,
+                           dedupe=args.data_dedupe)
+        valid_set = dataset(valid_path, args.frame_bar, score_type, score_sig, args.data_binarize,
+                            args.data_augment, args.data_export, False, nb_jobs=args.data_jobs, pack=args.data_pack,
+                            dedupe=args.data_dedupe)
         # Normalization
         if args.data_normalize:
             min_v, max_v, min_p, max_p, vals = stats_dataset([train_set, valid_set, test_set])
@@ -72,16 +137,34 @@ def import_dataset(args):
                     sampler.max_p = max_p
                 else:
                     sampler.min_p = 0
-        # Get sampler
-        train_indices, valid_indices, test_indices = list(range(len(train_set))), list(range(len(valid_set))), \
-                                                     list(range(len(test_set)))
+        # Multi-class models take uint8 class indices
+        for sampler in [train_set, valid_set, test_set]:
+            sampler.classes = bool(args.data_classes and args.num_classes > 1)
+        # Keep all the bars in shared memory (once the crop and scale are known)
+        if args.data_memory and not args.data_sparse:
+            for sampler in [train_set, valid_set, test_set]:
+                sampler.load_memory()
+        # Get sampler (indices refer to the full store, also when bars are deduplicated)
+        train_indices, valid_indices, test_indices = list(range(train_set.nb_source)), \
+                                                     list(range(valid_set.nb_source)), \
+                                                     list(range(test_set.nb_source))
+        if args.data_query:
+            query = '(%s) AND (%s)' % (subset_query(args.score_type, args.score_sig), args.data_query)
+            train_indices, valid_indices, test_indices = [cur_set.query(query) for cur_set in
+                                                          [train_set, valid_set, test_set]]
+            print('[Query selected %d / %d / %d bars]' % (len(train_indices), len(valid_indices),
+                                                          len(test_indices)))
+            for split, cur_indices in zip(['train', 'valid', 'test'], [train_indices, valid_indices, test_indices]):
+                if len(cur_indices) == 0:
+                    raise ValueError('bar query "%s" selects no bar of the %s set' % (query, split))
         if args.subsample > 0:
             train_indices = train_indices[:args.subsample]
             valid_indices = valid_indices[:args.subsample]
             test_indices = test_indices[:args.subsample]
-        train_sampler = SubsetRandomSampler(train_indices)
-        valid_sampler = SubsetRandomSampler(valid_indices)
-        test_sampler = SubsetRandomSampler(test_indices)
+        train_sampler = train_set.weighted_sampler(train_indices, args.data_dedupe_power)
+        # Evaluation visits each bar once (no weighted sampling with replacement)
+        valid_sampler = valid_set.subset_sampler(valid_indices)
+        test_sampler = test_set.subset_sampler(test_indices)
     elif args.dataset == "midi_folder":  # One folder with all midi files
         data_set = PianoRollRep(args.bar_dir, args.frame_bar, export=False)
         data_set_size = len(data_set)
@@ -105,27 +188,149 @@ def import_dataset(args):
         print("Oh no, too bad: unknown dataset " + args.dataset + ".\n")
         exit()
 
-    # Create all the loaders
+    # Keep what is needed to rebuild the loaders without going through the midi files again
+    if snapshot is not None:
+        DataSnapshot(args, [train_set, valid_set, test_set], [train_indices, valid_indices, test_indices]).save(snapshot)
+    return create_loaders(train_set, valid_set, test_set, train_sampler, valid_sampler, test_sampler, args,
+                          [train_indices, valid_indices, test_indices])
+
+
+# Create all the loaders
+def create_loaders(train_set, valid_set, test_set, train_sampler, valid_sampler, test_sampler, args, indices=None):
     train_loader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, num_workers=args.nbworkers,
-                                               drop_last=True, sampler=train_sampler, pin_memory=True)
+                                               drop_last=True, sampler=train_sampler, pin_memory=True,
+                                               collate_fn=train_set.collate)
     valid_loader = torch.utils.data.DataLoader(valid_set, batch_size=args.batch_size, num_workers=args.nbworkers,
-                                               drop_last=True, sampler=valid_sampler, pin_memory=True)
+                                               drop_last=True, sampler=valid_sampler, pin_memory=True,
+                                               collate_fn=valid_set.collate)
     test_loader = torch.utils.data.DataLoader(test_set, batch_size=args.batch_size, num_workers=args.nbworkers,
-                                              drop_last=True, sampler=test_sampler, shuffle=False, pin_memory=True)
-    batch = next(iter(train_loader))
-    args.input_size = batch[0].shape
+                                              drop_last=True, sampler=test_sampler, shuffle=False, pin_memory=True,
+                                              collate_fn=test_set.collate)
+    # Input size is known from the store metadata (no need to load a batch)
+    args.input_size = torch.Size(train_set.manifest()['input_size'])
+    args.data_fingerprint = data_fingerprint([train_set, valid_set, test_set], indices)
     return train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args
 
 
+# Loaders over streaming datasets (no sampler, the stream shuffles itself)
+def stream_loaders(train_set, valid_set, test_set, args):
+    loaders = [torch.utils.data.DataLoader(cur_set, batch_size=args.batch_size, num_workers=args.nbworkers,
+                                           drop_last=True, pin_memory=True, collate_fn=cur_set.collate)
+               for cur_set in [train_set, valid_set, test_set]]
+    args.input_size = torch.Size(train_set.manifest()['input_size'])
+    args.data_fingerprint = data_fingerprint([train_set, valid_set, test_set])
+    return loaders[0], loaders[1], loaders[2], train_set, valid_set, test_set, args
+
+
+# Default location of the data snapshot of an experiment (one file per set of data arguments)
+def snapshot_path(args):
+    data_args = {a: getattr(args, a, None) for a in DataSnapshot.ARGS}
+    data_hash = hashlib.md5(json.dumps(data_args, sort_keys=True).encode()).hexdigest()[:8]
+    data_variants = [args.dataset, args.frame_bar, args.score_type, args.score_sig, data_hash]
+    return args.output_path + '/data_' + '_'.join([str(m) for m in data_variants]) + '.th'
+
+
+class DataSnapshot(object):
+    """
+    Description of the data side of an experiment: reference to the bar stores,
+    indices of each split, normalization and pitch crop. Datasets and loaders are
+    rebuilt from it without exporting, hashing or scanning the midi files.
+
+    Args:
+        args: arguments used for the data import
+        data_sets (list): train, valid and test sets
+        indices (list): indices of the bars (or windows) used in each split
+    """
+
+    # Arguments that the datasets and loaders depend on
+    ARGS = ['dataset', 'midi_path', 'frame_bar', 'score_type', 'score_sig', 'data_normalize', 'data_binarize',
+            'data_pitch', 'data_augment', 'data_pack', 'data_sparse', 'data_memory', 'data_query', 'data_dedupe',
+            'data_dedupe_power', 'data_window', 'data_classes', 'num_classes', 'data_stream', 'subsample']
+
+    def __init__(self, args, data_sets, indices):
+        train_set = data_sets[0]
+        self.state = {'version': STORE_VERSION,
+                      'args': {a: getattr(args, a, None) for a in self.ARGS},
+                      'dataset': train_set.__class__.__name__,
+                      'params': {'frame_bar': train_set.frame_bar, 'score_type': train_set.score_type,
+                                 'score_sig': train_set.score_sig, 'binarize': train_set.binarize,
+                                 'augment': train_set.augment, 'pack': train_set.pack, 'dedupe': train_set.dedupe},
+                      'window': getattr(train_set, 'window', 1),
+                      'sets': [{'root_dir': cur_set.root_dir, 'training': cur_set.training,
+                                'fingerprint': cur_set.store.fingerprint,
+                                'indices': torch.as_tensor(np.asarray(cur_indices, dtype=np.int64))}
+                               for cur_set, cur_indices in zip(data_sets, indices)],
+                      'crop': [int(train_set.min_p), int(train_set.max_p)],
+                      'max_v': float(train_set.max_v),
+                      'classes': train_set.classes,
+                      'memory': train_set.memory is not None,
+                      'data_fingerprint': data_fingerprint(data_sets, indices)}
+
+    def save(self, path):
+        # Only plain types and tensors (no dataset or loader objects), written aside then renamed
+        # so that an interrupted run never leaves a partial snapshot
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        torch.save(self.state, tmp_path)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        snapshot = cls.__new__(cls)
+        snapshot.state = torch.load(path)
+        return snapshot
+
+    # Check that the snapshot was made with the same data arguments
+    def matches(self, args):
+        return self.state['version'] == STORE_VERSION and \
+               all([self.state['args'].get(a) == getattr(args, a, None) for a in self.ARGS])
+
+    def datasets(self):
+        """
+        Returns:
+            list: train, valid and test sets, opened on their stores as they were.
+        Raises:
+            ValueError: if a store or its midi files changed since the snapshot was taken.
+        """
+        dataset = {'PianoRollRep': PianoRollRep, 'PianoRollEvents': PianoRollEvents,
+                   'PianoRollWindows': partial(PianoRollWindows, window=self.state['window'])}[self.state['dataset']]
+        data_sets = []
+        for cur in self.state['sets']:
+            if not store_exists(bar_path(cur['root_dir'], self.state['params']['frame_bar'],
+                                         self.state['params']['score_type'], self.state['params']['score_sig'])):
+                raise ValueError('missing store in ' + cur['root_dir'])
+            cur_set = dataset(cur['root_dir'], training=cur['training'], update=False, **self.state['params'])
+            if cur_set.store.fingerprint != cur['fingerprint']:
+                raise ValueError('store of ' + cur['root_dir'] + ' changed')
+            # Added or edited midi files are handled by the incremental update of a full import
+            if cur_set.sources_changed():
+                raise ValueError('midi files of ' + cur['root_dir'] + ' changed')
+            cur_set.min_p, cur_set.max_p = self.state['crop']
+            cur_set.max_v = self.state['max_v']
+            cur_set.classes = self.state['classes']
+            if self.state['memory']:
+                cur_set.load_memory()
+            data_sets.append(cur_set)
+        return data_sets
+
+    def restore(self, args):
+        """ Same outputs as import_dataset """
+        data_sets = self.datasets()
+        samplers = [cur_set.weighted_sampler(cur['indices'].tolist(), self.state['args']['data_dedupe_power'])
+                    if cur_set.training else cur_set.subset_sampler(cur['indices'].tolist())
+                    for cur_set, cur in zip(data_sets, self.state['sets'])]
+        print('[Restored data snapshot (%d / %d / %d bars)]' % tuple([len(c['indices']) for c in self.state['sets']]))
+        return create_loaders(*data_sets, *samplers, args, [cur['indices'] for cur in self.state['sets']])
+
+
 # Take the folder of midi files and output Piano-roll representation
 class PianoRollRep(Dataset):
     def __init__(self, root_dir, frame_bar=64, score_type='all', score_sig='all', binarize=False, augment=False,
-                 export=False, training=True):
+                 export=False, training=True, nb_jobs=1, pack=False, dedupe=False, update=True):
         # path directory with midi files
         self.root_dir = root_dir
         # files names .mid
-        self.midi_files = np.array([files_names for files_names in os.listdir(root_dir) if
-                                    (files_names.endswith('.midi') or files_names.endswith('.mid'))])
+        self.midi_files = np.sort([files_names for files_names in os.listdir(root_dir) if
+                                   (files_names.endswith('.midi') or files_names.endswith('.mid'))])
         # number of frame per bar
         self.frame_bar = frame_bar
         # Type of score (mono or all)
@@ -134,104 +339,652 @@ class PianoRollRep(Dataset):
         self.score_sig = score_sig
         # Binarize the data or not
         self.binarize = binarize
+        # Transport binarized bars as packed bits (unpacked at the model boundary)
+        self.pack = pack and binarize
         # Check if this is a train set
         self.training = training
-        # Data augmentation
+        # Number of processes used for export
+        self.nb_jobs = nb_jobs
+        # Serve each distinct bar once (with its multiplicity for sampling)
+        self.dedupe = dedupe
+        self.store_name = STORE_UNIQUE if dedupe else STORE_NAME
+        # Data augmentation (applied on whole batches, with independent draws per bar)
         self.augment = augment
-        self.transform = transform.RandomApply(
-            [transform.RandomChoice([Transpose(6), MaskRows(), TimeFlip(), PitchFlip()])], p=.5)
+        self.transform = BatchAugment([BatchTranspose(6), BatchMaskRows(), BatchTimeFlip(), BatchPitchFlip()], p=.5)
         # Base values for eventual normalization
         self.min_p = 0
         self.max_p = 128
         self.max_v = 1.
+        # Serve uint8 class indices (targets of multi-class models) instead of float piano-rolls
+        self.classes = False
         # path to the sliced piano-roll
-        self.bar_dir = root_dir + "/piano_roll_bar_" + str(
-            self.frame_bar) + '_' + self.score_type + '_' + self.score_sig
+        self.bar_dir = bar_path(root_dir, self.frame_bar, self.score_type, self.score_sig)
         if not os.path.exists(self.bar_dir):
             os.mkdir(self.bar_dir)
+        # (without update, the store is taken as is, e.g. when restored from a snapshot)
+        if export or not store_exists(self.bar_dir):
             self.bar_export()
-        else:
-            if export:
-                self.bar_export()
-        # files names .pt
-        self.bar_files = np.array([files_names for files_names in os.listdir(self.bar_dir)
-                                   if files_names.endswith('.pt')])
+        elif update:
+            self.bar_update()
+        # metadata of each bar (for query-based subsets)
+        if update:
+            build_bar_index(self.bar_dir, self.root_dir)
+        # number of bars in the full store (indices of subsets and samplers refer to it)
+        self.nb_source = open_store(self.bar_dir).count
+        # distinct bars and their multiplicity
+        if self.dedupe:
+            unique_store(self.bar_dir)
+            self.counts, self.inverse = load_unique_counts(self.bar_dir)
+        # contiguous store of all (or distinct) bars
+        self.store = open_store(self.bar_dir, self.store_name)
+        # bit-packed version of the store
+        if self.pack:
+            if not BarStore.exists(self.bar_dir, self.store_name + '_packed'):
+                pack_store(self.bar_dir, self.store_name, self.store_name + '_packed')
+            self.packed = BarStore(self.bar_dir, self.store_name + '_packed')
         # number of tracks in data set
         self.nb_track = np.size(self.midi_files)
         # number of bars
-        self.nb_bars = np.size(self.bar_files)
+        self.nb_bars = len(self.store)
+        # in-RAM copy of the bars (see load_memory)
+        self.memory = None
 
     def __len__(self):
         return self.nb_bars
 
     def __getitem__(self, index):
-        cur_track = torch.load(self.bar_dir + '/' + self.bar_files[index])
-        cur_track /= self.max_v
+        if self.memory is not None:
+            output = self.memory[index]
+            if self.pack:
+                return output
+            # Binarized bars are stored as booleans, other ones as raw velocities
+            if not self.binarize:
+                output = output.float() / self.max_v
+            if self.classes:
+                return output.to(torch.uint8)
+            return output.float()
+        if self.pack:
+            return torch.from_numpy(self.packed[index])[..., self.min_p:(self.max_p + 1), :]
+        # Zero-copy view on the memory-mapped store (normalization makes the only copy)
+        cur_track = torch.from_numpy(self.store[index])[..., self.min_p:(self.max_p + 1), :]
+        if self.classes and self.binarize:
+            return (cur_track > 0).to(torch.uint8)
+        output = cur_track / self.max_v
+        if self.classes:
+            # Same classes as the truncation of the float bars (as done for the targets)
+            return output.to(torch.uint8)
         if self.binarize:
-            cur_track[cur_track > 0] = 1
-        output = cur_track[self.min_p:(self.max_p + 1), :]
+            output[output > 0] = 1
+        return output
+
+    # Whether the midi files differ from the ones of the store (only files of another size or time are hashed)
+    def sources_changed(self):
+        manifest = load_manifest(self.bar_dir)
+        if manifest is None:
+            return True
+        entries = hash_files(self.root_dir, self.midi_files, manifest)
+        return {f: e['hash'] for f, e in entries.items()} != {f: e['hash'] for f, e in manifest['files'].items()}
+
+    # Shape, crop and content of the bars served by the dataset
+    def manifest(self):
+        return {'bar_shape': list(self.store.bar_shape), 'dtype': str(self.store.dtype), 'count': self.nb_bars,
+                'crop': [int(self.min_p), int(self.max_p)], 'max_v': float(self.max_v),
+                'input_size': [min(self.max_p + 1, self.store.bar_shape[0]) - self.min_p, self.frame_bar],
+                'binarize': bool(self.binarize), 'fingerprint': self.store.fingerprint}
+
+    # Sampler over the stored bars reproducing the distribution of a subset of the full store
+    # (power < 1 flattens the distribution, 0 draws every distinct bar uniformly)
+    def weighted_sampler(self, indices, power=1.):
+        if not self.dedupe:
+            return SubsetRandomSampler(indices)
+        counts = np.bincount(self.inverse[indices], minlength=self.nb_bars).astype(np.float64)
+        weights = np.where(counts > 0, counts ** power, 0.)
+        return WeightedRandomSampler(torch.from_numpy(weights), len(indices))
+
+    # Sampler visiting each bar of a subset exactly once (through its stored copy when bars are deduplicated)
+    def subset_sampler(self, indices):
+        if self.dedupe:
+            indices = self.inverse[np.asarray(indices, dtype=np.int64)].tolist()
+        return SubsetRandomSampler(indices)
+
+    # Indices of the bars matching an SQL condition on the metadata index
+    def query(self, where):
+        return query_bars(self.bar_dir, where)
+
+    # Load all the bars in a single tensor shared by the DataLoader workers (crop is applied once here)
+    def load_memory(self, chunk=1024):
+        store = self.packed if self.pack else self.store
+        if self.pack:
+            dtype = torch.uint8
+        elif self.binarize:
+            dtype = torch.bool
+        else:
+            # Velocities are integers, so that bytes are enough unless notes pile up
+            stats = store.stats()
+            integers = all([v == int(v) for v, _ in stats['counts']])
+            dtype = torch.uint8 if (integers and stats['min'] >= 0 and stats['max'] <= 255) else torch.float32
+        n_pitch = min(self.max_p + 1, store.bar_shape[0]) - self.min_p
+        memory = torch.empty((len(store), n_pitch, store.bar_shape[1]), dtype=dtype).share_memory_()
+        for start in range(0, len(store), chunk):
+            x = torch.from_numpy(np.array(store.data[start:start + chunk, self.min_p:(self.max_p + 1)]))
+            memory[start:start + x.shape[0]] = (x > 0) if dtype == torch.bool else x.to(dtype)
+        self.memory = memory
+        print('[Loaded %d bars in memory (%.1f MB)]' % (len(store), memory.numel() * memory.element_size() / 2 ** 20))
+
+    # Augment a whole [B, P, T] batch of training bars
+    def augment_batch(self, x):
+        if self.augment and self.training:
+            x = self.transform(x)
+        return x
+
+    # Assemble a batch (in the DataLoader workers)
+    def collate(self, batch):
+        if self.pack:
+            return default_collate(batch)
+        return self.augment_batch(default_collate(batch))
+
+    # Turn a transported batch into the piano-rolls (or class indices) expected by the models
+    def unpack(self, x):
+        if self.pack:
+            # Packed bars are augmented once unpacked (on the model device)
+            return self.augment_batch(unpack_bits(x, self.frame_bar, torch.uint8 if self.classes else torch.float))
+        return x
+
+    # Parameters that the exported bars depend on
+    def export_params(self):
+        return export_params(self.frame_bar, self.score_type, self.score_sig)
+
+    # Pre-processing of the data: loading in a sliced piano roll
+    def bar_export(self, reuse=None, entries=None):
+        # Bars of unchanged files are copied from the previous store
+        reuse = reuse or {}
+        if entries is None:
+            entries = hash_files(self.root_dir, self.midi_files)
+        store = BarStoreWriter(self.bar_dir, (128, self.frame_bar))
+        # Files already sliced by a streaming run are not parsed again
+        partials = [f for f in self.midi_files if f not in reuse and
+                    os.path.exists(partial_path(self.bar_dir, entries[f]['hash']))]
+        # Files with another signature are filtered from their header, before any parsing
+        skipped = self.signature_skip([f for f in self.midi_files if f not in reuse and f not in partials])
+        jobs = [(self.root_dir, f, self.frame_bar, self.score_type, self.score_sig) for f in self.midi_files
+                if f not in reuse and f not in partials and f not in skipped]
+        failed = set()
+        if 'maestro' in self.root_dir:
+            # Beat tracking runs in its own pool of Java processes, before the slicing (failed files are skipped)
+            failed = set(prefetch_downbeats(self.root_dir, [j[1] for j in jobs], self.nb_jobs,
+                                            hashes={f: entries[f]['hash'] for f in entries}))
+            jobs = [j for j in jobs if j[1] not in failed]
+        if self.nb_jobs > 1 and len(jobs) > 1:
+            # Fan files out to the workers, results come back in file order
+            pool = multiprocessing.Pool(self.nb_jobs)
+            tracks = pool.imap(track_export_safe, jobs)
+        else:
+            pool, tracks = None, map(track_export_safe, jobs)
+        for file_name in tqdm(self.midi_files):
+            if file_name in reuse:
+                bars, bar_ids = reuse[file_name]
+            elif file_name in partials:
+                bars, bar_ids = load_partial(self.bar_dir, entries[file_name]['hash'])
+            elif file_name in skipped or file_name in failed:
+                bars, bar_ids = [], []
+            else:
+                bars, bar_ids = next(tracks)
+            entries[file_name]['nb_bars'] = len(bar_ids)
+            if file_name in failed:
+                entries[file_name]['failed'] = True
+            store.add_track(file_name, bars, bar_ids)
+        if pool is not None:
+            pool.close()
+            pool.join()
+        store.close()
+        # Files on which the beat tracker failed are kept without bars (updates take them as done, exports retry them)
+        save_manifest(self.bar_dir, self.export_params(), entries)
+        clear_partials(self.bar_dir)
+        # Keep the bit-packed, deduplicated and compressed versions in sync
+        if self.pack or BarStore.exists(self.bar_dir, STORE_PACKED):
+            pack_store(self.bar_dir)
+        if BarStore.exists(self.bar_dir, STORE_UNIQUE):
+            unique_store(self.bar_dir)
+        if CompressedBarStore.exists(self.bar_dir):
+            compress_store(self.bar_dir, codec=CompressedBarStore(self.bar_dir).codec)
+
+    # Files whose header signature does not match score_sig
+    def signature_skip(self, file_names):
+        if self.score_sig == 'all' or len(file_names) == 0:
+            return set()
+        index = midi_index(self.root_dir, self.midi_files)
+        skipped = set([f for f in file_names if index[f]['header'] is not None and
+                       not signature_match(index[f]['header'], self.score_sig)])
+        print('[Skipping %d files not in %s]' % (len(skipped), self.score_sig.replace('_', '/')))
+        return skipped
+
+    # Incremental export: only process added or changed files, drop bars from deleted ones
+    def bar_update(self):
+        manifest = load_manifest(self.bar_dir)
+        if manifest is None or manifest['params'] != self.export_params():
+            self.bar_export()
+            return
+        entries = hash_files(self.root_dir, self.midi_files, manifest)
+        previous = open_store(self.bar_dir)
+        tracks = {f: t for t, f in enumerate(previous.files)}
+        reuse = {}
+        for file_name in self.midi_files:
+            entry = manifest['files'].get(file_name)
+            if entry is not None and file_name in tracks and entry['hash'] == entries[file_name]['hash']:
+                reuse[file_name] = previous.track_bars(tracks[file_name])
+                # (keeps the beat tracking failures of unchanged files)
+                entries[file_name] = dict(entry, **entries[file_name])
+        nb_removed = len([f for f in manifest['files'] if f not in entries])
+        if len(reuse) == len(self.midi_files) and nb_removed == 0:
+            # Refresh sizes and times (e.g. after a touch) so that files are not hashed again
+            entries = {f: dict(manifest['files'][f], **entries[f]) for f in entries}
+            if entries != manifest['files']:
+                save_manifest(self.bar_dir, manifest['params'], entries)
+            return
+        print('[Updating bars: %d new or changed files, %d removed]' % (len(self.midi_files) - len(reuse),
+                                                                         nb_removed))
+        self.bar_export(reuse, entries)
+
+
+# Windows of consecutive bars of a track, taken as slices of the contiguous store
+class PianoRollWindows(PianoRollRep):
+    def __init__(self, root_dir, frame_bar=64, score_type='all', score_sig='all', binarize=False, augment=False,
+                 export=False, training=True, nb_jobs=1, pack=False, dedupe=False, update=True, window=2):
+        # Deduplication would break the order of the bars
+        super(PianoRollWindows, self).__init__(root_dir, frame_bar, score_type, score_sig, binarize, augment, export,
+                                               training, nb_jobs, pack, update=update)
+        # Number of bars in a window
+        self.window = window
+        # Windows start on bars followed by window - 1 consecutive bars of the same track
+        tracks, bars = self.store.tracks, self.store.bars
+        n = max(len(self.store) - window + 1, 0)
+        valid = np.ones(n, dtype=bool)
+        for j in range(1, window):
+            valid &= (tracks[j:n + j] == tracks[:n]) & (bars[j:n + j] == bars[:n] + j)
+        self.starts = np.nonzero(valid)[0]
+        # Subsets and samplers refer to windows
+        self.nb_source = len(self.starts)
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __getitem__(self, index):
+        # A slice of the store is a view of the window ([window, pitch, frames])
+        start = self.starts[index]
+        return super(PianoRollWindows, self).__getitem__(slice(start, start + self.window))
+
+    def manifest(self):
+        manifest = super(PianoRollWindows, self).manifest()
+        manifest['count'] = len(self.starts)
+        manifest['window'] = self.window
+        manifest['input_size'] = [self.window] + manifest['input_size']
+        return manifest
+
+    # Windows where all bars match an SQL condition
+    def query(self, where):
+        selected = query_bars(self.bar_dir, where)
+        valid = np.ones(len(self.starts), dtype=bool)
+        for j in range(self.window):
+            valid &= np.isin(self.starts + j, selected)
+        return np.nonzero(valid)[0].tolist()
+
+    # Augment whole windows (the bars of a window are transformed together)
+    def augment_batch(self, x):
+        if self.augment and self.training:
+            b, k, p, t = x.shape
+            x = self.transform(x.permute(0, 2, 1, 3).reshape(b, p, k * t))
+            x = x.view(b, p, k, t).permute(0, 2, 1, 3).contiguous()
+        return x
+
+
+# Sparse version of the piano-roll dataset: bars are stored as note events
+class PianoRollEvents(PianoRollRep):
+    def __init__(self, root_dir, frame_bar=64, score_type='all', score_sig='all', binarize=False, augment=False,
+                 export=False, training=True, nb_jobs=1, pack=False, dedupe=False, update=True):
+        # Events are already compact, so bit-packing is not used
+        super(PianoRollEvents, self).__init__(root_dir, frame_bar, score_type, score_sig, binarize, augment, export,
+                                              training, nb_jobs, dedupe=dedupe, update=update)
+        # (pitch, onset, offset, velocity) events derived from the dense store
+        events_store(self.bar_dir, self.store_name, self.store_name + '_events')
+        self.events = EventStore(self.bar_dir, self.store_name + '_events')
+
+    def __getitem__(self, index):
+        return torch.from_numpy(np.array(self.events[index]))
+
+    # Rasterize the whole batch at once (already cropped to the pitch range)
+    def collate(self, batch):
+        output = rasterize_events(batch, self.frame_bar, self.min_p, self.max_p) / self.max_v
+        if self.binarize:
+            output[output > 0] = 1
+        if self.classes:
+            output = output.to(torch.uint8)
+        return self.augment_batch(output)
+
+    def unpack(self, x):
+        # Single bars (dataset[index]) are still events
+        if x.dtype == torch.int16:
+            return self.collate([x.cpu()])[0].to(x.device)
+        return x
+
+
+# Stream piano-roll bars directly from the midi files (no prior export)
+class PianoRollStream(IterableDataset):
+    def __init__(self, root_dir, frame_bar=64, score_type='all', score_sig='all', binarize=False, augment=False,
+                 training=True, buffer_size=4096, write_through=False):
+        # path directory with midi files
+        self.root_dir = root_dir
+        # files names .mid
+        self.midi_files = np.sort([files_names for files_names in os.listdir(root_dir) if
+                                   (files_names.endswith('.midi') or files_names.endswith('.mid'))])
+        self.frame_bar = frame_bar
+        self.score_type = score_type
+        self.score_sig = score_sig
+        self.binarize = binarize
+        self.training = training
+        # Bars kept in memory to shuffle the stream (1 keeps the file order)
+        self.buffer_size = buffer_size if training else 1
+        # Save the bars of each parsed file into the persistent bar cache
+        self.write_through = write_through
+        self.augment = augment
+        self.transform = BatchAugment([BatchTranspose(6), BatchMaskRows(), BatchTimeFlip(), BatchPitchFlip()], p=.5)
+        # Base values for eventual normalization
+        self.min_p = 0
+        self.max_p = 128
+        self.max_v = 1.
+        self.pack = False
+        self.classes = False
+        # path to the sliced piano-roll (same cache as PianoRollRep)
+        self.bar_dir = bar_path(root_dir, self.frame_bar, self.score_type, self.score_sig)
+        if self.write_through and not os.path.exists(self.bar_dir):
+            os.mkdir(self.bar_dir)
+        self.nb_track = np.size(self.midi_files)
+        self.nb_bars = self.estimate_bars()
+
+    # Number of bars (exact if the cache was exported, otherwise estimated for progress bars)
+    def estimate_bars(self):
+        manifest = load_manifest(self.bar_dir) if os.path.exists(self.bar_dir) else None
+        if manifest is None:
+            return self.nb_track * 32
+        counts = [e['nb_bars'] for e in manifest['files'].values() if 'nb_bars' in e]
+        return int(mean(counts) * self.nb_track) if len(counts) > 0 else self.nb_track * 32
+
+    def __len__(self):
+        return self.nb_bars
+
+    # Shape and crop of the streamed bars (content is not known before parsing)
+    def manifest(self):
+        return {'bar_shape': [128, self.frame_bar], 'dtype': 'float32', 'count': self.nb_bars,
+                'crop': [int(self.min_p), int(self.max_p)], 'max_v': float(self.max_v),
+                'input_size': [min(self.max_p + 1, 128) - self.min_p, self.frame_bar],
+                'binarize': bool(self.binarize), 'fingerprint': None}
+
+    # Augment the whole batch at once
+    def collate(self, batch):
+        output = default_collate(batch)
         if self.augment and self.training:
             output = self.transform(output)
         return output
 
-    # Pre-processing of the data: loading in a sliced piano roll
-    def bar_export(self):
+    def unpack(self, x):
+        return x
+
+    # Bars of one file (from the write-through cache if available)
+    def track_bars(self, file_name):
+        content_hash = None
+        if self.write_through:
+            content_hash = file_hash(self.root_dir + '/' + file_name)
+            partial = load_partial(self.bar_dir, content_hash)
+            if partial is not None:
+                return partial
         if self.score_sig != 'all':
-            sig_split = self.score_sig.split('_')
-            target_sig_n = int(sig_split[0])
-            target_sig_d = int(sig_split[1])
-        # load midi in a pretty midi object
-        for index in np.arange(start=0, stop=np.size(self.midi_files)):
-            midi_data = pretty_midi.PrettyMIDI(self.root_dir + '/' + self.midi_files[index])
-            if (len(midi_data.time_signature_changes) > 0):
-                ts_n = midi_data.time_signature_changes[0].numerator
-                ts_d = midi_data.time_signature_changes[0].denominator
-                # Eventually check for time signature
-                if self.score_sig != 'all' and (ts_n != target_sig_n or ts_d != target_sig_d):
-                    print('Signature is [%d/%d] - skipped as not a 4/4 track' % (ts_n, ts_d))
-                    continue
-            downbeats = midi_data.get_downbeats()
-            if ('maestro' in self.root_dir):
-                print(self.root_dir + '/' + self.midi_files[index])
-                beat_cmd = ["java","-cp","/Users/esling/Downloads/met-align-master/bin","metalign.Main","-g","/Users/esling/Downloads/met-align-master/grammars/all.lpcfg","-b","20", self.root_dir + '/' + self.midi_files[index]]
-                try:
-                    output = subprocess.Popen(beat_cmd, stdout=subprocess.PIPE ).communicate()[0]
-                    print('Done.')
-                    # Retrieve finer downbeats
-                    vals = str(output).split('\\n')[-2]
-                    vals = vals.split(':')[1]
-                    vals = vals.split(',')
-                    downbeats = [float(x) / 1000000 for x in vals]
-                except:
-                    continue
-            bar_time = mean([downbeats[i + 1] - downbeats[i] for i in range(len(downbeats) - 1)])
-            fs = int(self.frame_bar / round(bar_time))
-            # Find a mono track if we only want a mono dataset
-            if self.score_type == 'mono':
-                found_track = 0
-                for i in range(len(midi_data.instruments)):
-                    piano_roll = midi_data.instruments[i].get_piano_roll(fs=fs)
-                    piano_roll_bin = piano_roll.copy()
-                    piano_roll_bin[piano_roll_bin > 0] = 1
-                    if np.sum(np.sum(piano_roll_bin, axis=0) > 1) == 0:
-                        found_track = 1
-                        break
-                if found_track == 0:
-                    continue
-            else:
-                # Otherwise take all tracks at once
-                piano_roll = midi_data.get_piano_roll(fs=fs)
-            for i in range(len(downbeats) - 1):
-                # compute the piano-roll for one bar and save it
-                sliced_piano_roll = np.array(piano_roll[:,
-                                             math.ceil(downbeats[i] * fs):math.ceil(downbeats[i + 1] * fs)])
-                if sliced_piano_roll.shape[1] > self.frame_bar:
-                    sliced_piano_roll = np.array(sliced_piano_roll[:, 0:self.frame_bar])
-                elif sliced_piano_roll.shape[1] < self.frame_bar:
-                    # sliced_piano_roll = np.pad(sliced_piano_roll, ((0, 0), (0, self.frame_bar - sliced_piano_roll.shape[1])), 'edge')
+            # Cheap header check before the full parse
+            try:
+                if not signature_match(scan_midi(self.root_dir + '/' + file_name), self.score_sig):
+                    return [], []
+            except Exception:
+                pass
+        bars, bar_ids = track_export_safe((self.root_dir, file_name, self.frame_bar, self.score_type,
+                                           self.score_sig))
+        if self.write_through:
+            save_partial(self.bar_dir, content_hash, bars, bar_ids, (128, self.frame_bar))
+        return bars, bar_ids
+
+    def process(self, bar):
+        output = torch.from_numpy(np.array(bar[self.min_p:(self.max_p + 1), :])) / self.max_v
+        if self.binarize:
+            output[output > 0] = 1
+        if self.classes:
+            return output.to(torch.uint8)
+        return output
+
+    def __iter__(self):
+        files = self.midi_files
+        # Each worker parses its own share of the files
+        worker = torch.utils.data.get_worker_info()
+        if worker is not None:
+            files = files[worker.id::worker.num_workers]
+        # Torch seeds every worker differently at each epoch
+        rng = random.Random(int(torch.randint(2 ** 31, (1,)).item()))
+        if self.training:
+            files = list(files)
+            rng.shuffle(files)
+        buffer = []
+        for file_name in files:
+            bars, _ = self.track_bars(file_name)
+            for bar in bars:
+                if len(buffer) < self.buffer_size:
+                    buffer.append(bar)
                     continue
-                sliced_piano_roll = torch.from_numpy(sliced_piano_roll).float()
-                torch.save(sliced_piano_roll, self.bar_dir + "/per_bar" + str(i) + "_track" + str(index) + ".pt")
+                # Yield a random element of the buffer and replace it with the new bar
+                i = rng.randrange(self.buffer_size)
+                yield self.process(buffer[i])
+                buffer[i] = bar
+        rng.shuffle(buffer)
+        for bar in buffer:
+            yield self.process(bar)
+
+
+# Slice one midi file into piano-roll bars
+def track_export(root_dir, file_name, frame_bar, score_type, score_sig):
+    return track_export_variants(root_dir, file_name, [(frame_bar, score_type, score_sig)])[0]
+
+
+# Slice one midi file into several variants (frame_bar, score_type, score_sig) of bars, parsing it once
+def track_export_variants(root_dir, file_name, variants):
+    results = [([], []) for _ in variants]
+    # load midi in a pretty midi object
+    midi_data = pretty_midi.PrettyMIDI(root_dir + '/' + file_name)
+    keep = [True] * len(variants)
+    if (len(midi_data.time_signature_changes) > 0):
+        ts_n = midi_data.time_signature_changes[0].numerator
+        ts_d = midi_data.time_signature_changes[0].denominator
+        # Eventually check for time signature
+        for v, (_, _, score_sig) in enumerate(variants):
+            if score_sig != 'all' and [ts_n, ts_d] != [int(s) for s in score_sig.split('_')]:
+                print('Signature is [%d/%d] - skipped as not a %s track' % (ts_n, ts_d, score_sig.replace('_', '/')))
+                keep[v] = False
+    if not any(keep):
+        return results
+    downbeats = midi_data.get_downbeats()
+    if ('maestro' in root_dir):
+        # Retrieve finer downbeats (cached across exports)
+        try:
+            downbeats = track_downbeats(root_dir, file_name, timeout=METALIGN_TIMEOUT)
+        except Exception:
+            return results
+        if downbeats is None:
+            return results
+    bar_time = mean([downbeats[i + 1] - downbeats[i] for i in range(len(downbeats) - 1)])
+    # Piano-rolls of all tracks at once are rendered once per sampling rate
+    rolls = {}
+    for v, (frame_bar, score_type, _) in enumerate(variants):
+        if not keep[v]:
+            continue
+        fs = int(frame_bar / round(bar_time))
+        # Mono bars are taken from one instrument per bar
+        if score_type == 'mono':
+            results[v] = mono_bars(midi_data, downbeats, fs, frame_bar)
+            continue
+        if fs not in rolls:
+            rolls[fs] = midi_data.get_piano_roll(fs=fs)
+        results[v] = slice_bars(rolls[fs], downbeats, fs, frame_bar)
+    return results
+
+
+# Sustain pedal windows of an instrument, in frames (as processed by get_piano_roll)
+def pedal_windows(instrument, fs, threshold=64):
+    windows, pedal_on = [], None
+    for cc in instrument.control_changes:
+        if cc.number != 64:
+            continue
+        time_now = int(cc.time * fs)
+        if pedal_on is None and cc.value >= threshold:
+            pedal_on = time_now
+        elif pedal_on is not None and cc.value < threshold:
+            windows.append((pedal_on, time_now))
+            pedal_on = None
+    return windows
+
+
+# Number of distinct pitches active at each frame of an instrument, computed from its note intervals
+def frame_polyphony(instrument, fs, n_frames):
+    poly = np.zeros(n_frames + 1, dtype=np.int32)
+    if instrument.is_drum or len(instrument.notes) == 0:
+        return poly[:-1]
+    # Same quantization as get_piano_roll
+    pitch = np.array([n.pitch for n in instrument.notes])
+    start = np.array([int(n.start * fs) for n in instrument.notes])
+    end = np.array([int(n.end * fs) for n in instrument.notes])
+    # The pedal holds the notes that sound during a window until its release
+    for pedal_on, pedal_off in pedal_windows(instrument, fs):
+        held = (end > start) & (start < pedal_off) & (end > pedal_on)
+        end[held] = np.maximum(end[held], pedal_off)
+    start, end = np.minimum(start, n_frames), np.minimum(end, n_frames)
+    valid = end > start
+    pitch, start, end = pitch[valid], start[valid], end[valid]
+    if len(pitch) == 0:
+        return poly[:-1]
+    # Merge overlapping notes of the same pitch (they fill the same cells)
+    order = np.lexsort((start, pitch))
+    pitch, start, end = pitch[order], start[order], end[order]
+    offset = pitch.astype(np.int64) * (n_frames + 1)
+    reach = np.maximum.accumulate(end + offset) - offset
+    first = np.ones(len(pitch), dtype=bool)
+    first[1:] = (pitch[1:] != pitch[:-1]) | (start[1:] >= reach[:-1])
+    last = np.append(np.nonzero(first)[0][1:] - 1, len(pitch) - 1)
+    np.add.at(poly, start[first], 1)
+    np.add.at(poly, reach[last], -1)
+    return np.cumsum(poly)[:-1]
+
+
+# Mono bars of a track: each bar is taken from the first instrument that plays it without polyphony
+def mono_bars(midi_data, downbeats, fs, frame_bar):
+    starts = np.array([math.ceil(d * fs) for d in downbeats], dtype=np.int64)
+    # Bars that are long enough at this resolution
+    bar_ids = np.nonzero(starts[1:] - starts[:-1] >= frame_bar)[0]
+    frames = starts[bar_ids][:, None] + np.arange(frame_bar)[None, :]
+    chosen = np.full(len(bar_ids), -1)
+    for i, instrument in enumerate(midi_data.instruments):
+        n_frames = int(fs * instrument.get_end_time())
+        if n_frames == 0 or len(bar_ids) == 0:
+            continue
+        poly = frame_polyphony(instrument, fs, n_frames)
+        # Bars must fit inside the piano-roll of the instrument
+        inside = frames[:, -1] < n_frames
+        bar_poly = poly[np.minimum(frames, n_frames - 1)].max(axis=1)
+        chosen[(chosen < 0) & inside & (bar_poly == 1)] = i
+    # Only the chosen instruments are rendered
+    rolls = {i: midi_data.instruments[i].get_piano_roll(fs=fs) for i in np.unique(chosen[chosen >= 0])}
+    bars, ids = [], []
+    for bar_id, i in zip(bar_ids, chosen):
+        if i < 0:
+            continue
+        bars.append(np.array(rolls[i][:, starts[bar_id]:starts[bar_id] + frame_bar]).astype(np.float32))
+        ids.append(int(bar_id))
+    return bars, ids
+
+
+# Cut a piano-roll along the downbeats
+def slice_bars(piano_roll, downbeats, fs, frame_bar):
+    bars, bar_ids = [], []
+    for i in range(len(downbeats) - 1):
+        # compute the piano-roll for one bar
+        sliced_piano_roll = np.array(piano_roll[:,
+                                     math.ceil(downbeats[i] * fs):math.ceil(downbeats[i + 1] * fs)])
+        if sliced_piano_roll.shape[1] > frame_bar:
+            sliced_piano_roll = np.array(sliced_piano_roll[:, 0:frame_bar])
+        elif sliced_piano_roll.shape[1] < frame_bar:
+            # sliced_piano_roll = np.pad(sliced_piano_roll, ((0, 0), (0, frame_bar - sliced_piano_roll.shape[1])), 'edge')
+            continue
+        bars.append(sliced_piano_roll.astype(np.float32))
+        bar_ids.append(i)
+    return bars, bar_ids
+
+
+# Process pool entry point (a corrupt file only loses its own bars)
+def track_export_safe(job):
+    try:
+        return track_export(*job)
+    except Exception as e:
+        print('Skipped %s (%s)' % (job[1], e))
+        return [], []
+
+
+def track_export_variants_safe(job):
+    try:
+        return track_export_variants(*job)
+    except Exception as e:
+        print('Skipped %s (%s)' % (job[1], e))
+        return [([], []) for _ in job[2]]
+
+
+# Export several variants of the bars (resolutions, score types, signatures) in a single pass over the midi files
+def export_variants(root_dir, frame_bars, score_types=['all'], score_sigs=['all'], nb_jobs=1):
+    variants = [(f, t, s) for f in frame_bars for t in score_types for s in score_sigs]
+    midi_files = np.sort([files_names for files_names in os.listdir(root_dir) if
+                          (files_names.endswith('.midi') or files_names.endswith('.mid'))])
+    entries = hash_files(root_dir, midi_files)
+    # Header index and downbeats are shared by all the variants
+    midi_index(root_dir, midi_files)
+    failed = set()
+    if 'maestro' in root_dir:
+        # Files on which the beat tracker failed are skipped (and recorded without bars in the manifests)
+        failed = set(prefetch_downbeats(root_dir, midi_files, nb_jobs, hashes={f: entries[f]['hash'] for f in entries}))
+    bar_dirs = [bar_path(root_dir, *v) for v in variants]
+    stores = []
+    for bar_dir, (frame_bar, _, _) in zip(bar_dirs, variants):
+        if not os.path.exists(bar_dir):
+            os.mkdir(bar_dir)
+        stores.append(BarStoreWriter(bar_dir, (128, frame_bar)))
+    variant_entries = [{f: dict(entries[f]) for f in entries} for _ in variants]
+    jobs = [(root_dir, f, variants) for f in midi_files if f not in failed]
+    if nb_jobs > 1 and len(jobs) > 1:
+        pool = multiprocessing.Pool(nb_jobs)
+        tracks = pool.imap(track_export_variants_safe, jobs)
+    else:
+        pool, tracks = None, map(track_export_variants_safe, jobs)
+    print('[Exporting %d variants]' % len(variants))
+    for file_name in tqdm(midi_files):
+        if file_name in failed:
+            for store, cur_entries in zip(stores, variant_entries):
+                cur_entries[file_name].update({'nb_bars': 0, 'failed': True})
+                store.add_track(file_name, [], [])
+            continue
+        for store, cur_entries, (bars, bar_ids) in zip(stores, variant_entries, next(tracks)):
+            cur_entries[file_name]['nb_bars'] = len(bar_ids)
+            store.add_track(file_name, bars, bar_ids)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    for bar_dir, store, cur_entries, variant in zip(bar_dirs, stores, variant_entries, variants):
+        store.close()
+        save_manifest(bar_dir, export_params(*variant), cur_entries)
+        clear_partials(bar_dir)
+        if BarStore.exists(bar_dir, STORE_PACKED):
+            pack_store(bar_dir)
+        if CompressedBarStore.exists(bar_dir):
+            compress_store(bar_dir, codec=CompressedBarStore(bar_dir).codec)
+        build_bar_index(bar_dir, root_dir)
 
 
 def test_data(args, batch):
@@ -249,25 +1002,28 @@ def test_data(args, batch):
 def stats_dataset(loaders):
     max_v, min_v, val, pitch_on, count_mono, count_poly = 0, 3000, {}, [], 0, 0
     for cur_loader in loaders:
-        train_val = cur_loader.training
-        cur_loader.training = False
-        for x in cur_loader:
-            max_v = max((torch.max(x), max_v))
-            min_v = min((torch.min(x), min_v))
-            val_t, counts = torch.unique(x, return_counts=True)
-            for i, v in enumerate(val_t):
-                v_c = int(v.item())
-                if val.get(v_c) is None:
-                    val[v_c] = 0
-                val[v_c] += counts[i]
-            x_sum = torch.sum(x, dim=1)
-            pitch_on.append(torch.nonzero(x_sum))
-            x[x > 0] = 1
-            if torch.sum(torch.sum(x, dim=0) > 1):
-                count_poly += 1
-            else:
-                count_mono += 1
-        cur_loader.training = train_val
+        # Cached statistics of the full (uncropped) store, with all the copies of deduplicated bars
+        stats = (open_store(cur_loader.bar_dir) if cur_loader.dedupe else cur_loader.store).stats()
+        if stats['max'] is None:
+            continue
+        counts = stats['counts']
+        if cur_loader.binarize:
+            # Statistics of the binarized bars follow from the raw value counts
+            counts = [[0, sum([c for v, c in counts if v <= 0])], [1, sum([c for v, c in counts if v > 0])]]
+            counts = [[v, c] for v, c in counts if c > 0]
+            scale = 1.
+        else:
+            scale = cur_loader.max_v
+        max_v = max(max([v for v, c in counts]) / scale, max_v)
+        min_v = min(min([v for v, c in counts]) / scale, min_v)
+        for v, c in counts:
+            v_c = int(v / scale)
+            if val.get(v_c) is None:
+                val[v_c] = 0
+            val[v_c] += c
+        pitch_on.append(torch.tensor(stats['pitch_on'], dtype=torch.long))
+        count_poly += stats['poly']
+        count_mono += stats['mono']
     pitch_on = torch.unique(torch.cat(pitch_on))
     min_p, max_p = int(min(pitch_on)), int(max(pitch_on))
     if min_p > 5:
@@ -308,8 +1064,36 @@ if __name__ == "__main__":
     parser.add_argument('--data_pitch', type=int, default=1, help='constrain pitches in the data')
     parser.add_argument('--data_export', type=int, default=0, help='recompute the dataset (for debug purposes)')
     parser.add_argument('--data_augment', type=int, default=1, help='use data augmentation')
+    parser.add_argument('--data_jobs', type=int, default=1, help='number of processes for the export')
+    parser.add_argument('--data_pack', type=int, default=0, help='store and load binarized bars as packed bits')
+    parser.add_argument('--data_stream', type=int, default=0, help='stream bars from midi (2 = also fill the cache)')
+    parser.add_argument('--data_sparse', type=int, default=0, help='load bars as note events rasterized per batch')
+    parser.add_argument('--data_memory', type=int, default=0, help='keep all bars in a shared in-memory tensor')
+    parser.add_argument('--data_query', type=str, default='', help='SQL condition on the bar index (uses the all_all export, mono = one pitch over all instruments)')
+    parser.add_argument('--data_dedupe', type=int, default=0, help='store identical bars once and sample by multiplicity')
+    parser.add_argument('--data_dedupe_power', type=float, default=1., help='power on multiplicities (< 1 flattens)')
+    parser.add_argument('--data_window', type=int, default=1, help='serve windows of consecutive bars')
+    parser.add_argument('--data_classes', type=int, default=1, help='serve uint8 class indices to multi-class models')
+    parser.add_argument('--num_classes', type=int, default=2, help='number of velocity classes')
+    parser.add_argument('--export_frames', type=str, default='', help='only export these frame_bar (e.g. 64,128) in one pass')
+    parser.add_argument('--export_compress', type=str, default='', help='only add compressed copies of the stores (zlib | lz4)')
+    parser.add_argument('--export_types', type=str, default='all', help='score types for --export_frames (e.g. mono,all)')
+    parser.add_argument('--export_sigs', type=str, default='all', help='signatures for --export_frames (e.g. 4_4,all)')
     # Parse the arguments
     args = parser.parse_args()
+    # Single-pass export of several variants
+    if args.export_frames:
+        for split in ['train', 'valid', 'test']:
+            export_variants(dataset_path(args) + '/' + split, [int(f) for f in args.export_frames.split(',')],
+                            args.export_types.split(','), args.export_sigs.split(','), args.data_jobs)
+        exit()
+    # Compressed copies of the stores (for archival or transfers)
+    if args.export_compress:
+        for split in ['train', 'valid', 'test']:
+            cur_set = PianoRollRep(dataset_path(args) + '/' + split, args.frame_bar, args.score_type, args.score_sig,
+                                   nb_jobs=args.data_jobs)
+            compress_store(cur_set.bar_dir, codec=args.export_compress)
+        exit()
     # Data importing
     train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args)
     # %%
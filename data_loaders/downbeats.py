@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import hashlib
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+from .bar_store import file_hash
+
+# Location of the met-align beat tracker (Java)
+METALIGN_PATH = os.environ.get('METALIGN_PATH', '/Users/esling/Downloads/met-align-master')
+METALIGN_GRAMMAR = METALIGN_PATH + '/grammars/all.lpcfg'
+METALIGN_BEAM = 20
+# Time limit (in seconds) of the tracker on one file
+METALIGN_TIMEOUT = 3600
+# Cache kept next to the midi files (shared by all frame_bar / score_type exports)
+DOWNBEATS_DIR = 'downbeats_cache'
+
+
+# -----------------------------------------------------------
+#
+# Downbeat extraction with met-align
+#
+# -----------------------------------------------------------
+
+def metalign_cmd(path, grammar=METALIGN_GRAMMAR, beam=METALIGN_BEAM):
+    return ["java", "-cp", METALIGN_PATH + "/bin", "metalign.Main", "-g", grammar, "-b", str(beam), path]
+
+
+# Retrieve the downbeats (in seconds) from the met-align output
+def parse_metalign(output):
+    vals = str(output).split('\\n')[-2]
+    vals = vals.split(':')[1]
+    vals = vals.split(',')
+    return [float(x) / 1000000 for x in vals]
+
+
+def run_metalign(path, grammar=METALIGN_GRAMMAR, beam=METALIGN_BEAM, timeout=METALIGN_TIMEOUT):
+    """
+    Run met-align on a single file.
+
+    Returns:
+        list: downbeats in seconds, or None if the output could not be parsed.
+    Raises:
+        subprocess.TimeoutExpired: if the tracker runs longer than timeout.
+        subprocess.CalledProcessError: if the tracker exits with an error.
+        OSError: if java cannot be run.
+    """
+    output = subprocess.run(metalign_cmd(path, grammar, beam), stdout=subprocess.PIPE, timeout=timeout,
+                            check=True).stdout
+    try:
+        return parse_metalign(output)
+    except (IndexError, ValueError):
+        return None
+
+
+# -----------------------------------------------------------
+#
+# Persistent cache (keyed by file content, tracker location and parameters)
+#
+# -----------------------------------------------------------
+
+def downbeats_key(content_hash, grammar=METALIGN_GRAMMAR, beam=METALIGN_BEAM):
+    params = '%s|%s|%s|%s' % (content_hash, os.path.abspath(METALIGN_PATH), os.path.basename(grammar), beam)
+    return hashlib.md5(params.encode()).hexdigest()
+
+
+def downbeats_path(root_dir, key):
+    return os.path.join(root_dir, DOWNBEATS_DIR, key + '.json')
+
+
+def load_downbeats(root_dir, key):
+    """
+    Returns:
+        (bool, list): whether the entry exists, and the cached downbeats.
+    """
+    path = downbeats_path(root_dir, key)
+    if not os.path.exists(path):
+        return False, None
+    with open(path) as f:
+        return True, json.load(f)['downbeats']
+
+
+def save_downbeats(root_dir, key, file_name, downbeats):
+    path = downbeats_path(root_dir, key)
+    if not os.path.exists(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written aside then renamed, so that concurrent exports never read a partial entry
+    tmp_path = path + '.%d.tmp' % os.getpid()
+    with open(tmp_path, 'w') as f:
+        json.dump({'file': str(file_name), 'downbeats': downbeats}, f)
+    os.replace(tmp_path, path)
+
+
+def track_downbeats(root_dir, file_name, grammar=METALIGN_GRAMMAR, beam=METALIGN_BEAM, timeout=METALIGN_TIMEOUT):
+    """
+    Downbeats of a single file, computed with met-align only if they are not cached.
+
+    Returns:
+        list: downbeats in seconds (None if the tracker output could not be parsed).
+    Raises:
+        the errors of run_metalign (failures are not cached).
+    """
+    key = downbeats_key(file_hash(root_dir + '/' + file_name), grammar, beam)
+    found, downbeats = load_downbeats(root_dir, key)
+    if found:
+        return downbeats
+    print(root_dir + '/' + file_name)
+    downbeats = run_metalign(root_dir + '/' + file_name, grammar, beam, timeout)
+    print('Done.')
+    if downbeats is not None:
+        save_downbeats(root_dir, key, file_name, downbeats)
+    return downbeats
+
+
+def prefetch_downbeats(root_dir, file_names, nb_jobs=1, timeout=METALIGN_TIMEOUT, grammar=METALIGN_GRAMMAR,
+                       beam=METALIGN_BEAM, hashes=None):
+    """
+    Fill the cache for a list of files with a bounded pool of concurrent met-align processes.
+    Only successful runs are cached: failed files are recorded without bars in the manifests, and tried
+    again on the next full export (--data_export).
+
+    Args:
+        root_dir (str): directory of the midi files (holding the cache)
+        file_names (list): files to process
+        nb_jobs (int): maximum number of concurrent Java processes. default: 1
+        timeout (float): time limit (in seconds) for one file. default: METALIGN_TIMEOUT
+        hashes (dict): already known content hashes of the files. default: None
+    Returns:
+        list: files on which met-align failed (timeout, error or unparsable output).
+    """
+    hashes = hashes or {}
+    missing = []
+    for file_name in file_names:
+        key = downbeats_key(hashes.get(file_name) or file_hash(root_dir + '/' + file_name), grammar, beam)
+        if not os.path.exists(downbeats_path(root_dir, key)):
+            missing.append((file_name, key))
+    if len(missing) == 0:
+        return []
+
+    def compute(job):
+        file_name, key = job
+        try:
+            downbeats = run_metalign(root_dir + '/' + file_name, grammar, beam, timeout)
+        except subprocess.TimeoutExpired:
+            print('Timeout on %s' % file_name)
+            return file_name
+        except (OSError, subprocess.CalledProcessError) as e:
+            print('Skipped %s (%s)' % (file_name, e))
+            return file_name
+        if downbeats is None:
+            print('Skipped %s (unparsable met-align output)' % file_name)
+            return file_name
+        save_downbeats(root_dir, key, file_name, downbeats)
+
+    print('[Tracking downbeats of %d files]' % len(missing))
+    # Threads only wait on the Java processes, which run concurrently
+    with ThreadPoolExecutor(max(1, nb_jobs)) as pool:
+        failed = [f for f in tqdm(pool.map(compute, missing), total=len(missing)) if f is not None]
+    return failed
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+
+import os
+import json
+import struct
+from .bar_store import hash_files
+
+# Per-file index kept next to the midi files (shared by all exports)
+MIDI_INDEX = 'midi_index.json'
+
+
+# -----------------------------------------------------------
+#
+# Header-only scan of a standard MIDI file
+#
+# -----------------------------------------------------------
+
+def read_varlen(data, pos):
+    value = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value = (value << 7) | (byte & 0x7F)
+        if byte < 0x80:
+            return value, pos
+
+
+def scan_midi(path):
+    """
+    Read the meta information of a MIDI file without building notes or piano-rolls.
+
+    Only the event framing is decoded: channel events are skipped, apart from
+    note-on and program changes that are used to count the instruments (in the
+    same way as pretty_midi, one per track, channel and program).
+
+    Returns:
+        dict: first time signature ([numerator, denominator] or None), first tempo
+        (bpm), duration (seconds, end of the last track) and number of instruments.
+    """
+    with open(path, 'rb') as f:
+        data = f.read()
+    if data[:4] != b'MThd':
+        raise ValueError('Not a MIDI file')
+    header_len = struct.unpack('>I', data[4:8])[0]
+    _, nb_tracks, division = struct.unpack('>HHH', data[8:14])
+    pos = 8 + header_len
+    signatures, tempos, instruments = [], [], set()
+    end_tick = 0
+    for track in range(nb_tracks):
+        if pos + 8 > len(data):
+            break
+        chunk, length = data[pos:pos + 4], struct.unpack('>I', data[pos + 4:pos + 8])[0]
+        pos += 8
+        end = min(pos + length, len(data))
+        if chunk != b'MTrk':
+            pos = end
+            continue
+        tick, status, programs = 0, 0, {}
+        while pos < end:
+            delta, pos = read_varlen(data, pos)
+            tick += delta
+            # Data bytes first: running status (of the last channel event, meta and sysex events leave it unchanged)
+            event = status
+            if data[pos] >= 0x80:
+                event = data[pos]
+                pos += 1
+                if event < 0xF0:
+                    status = event
+            if event == 0xFF:
+                # Meta event
+                meta_type = data[pos]
+                length, pos = read_varlen(data, pos + 1)
+                if meta_type == 0x58 and length >= 2:
+                    signatures.append((tick, data[pos], 2 ** data[pos + 1]))
+                elif meta_type == 0x51 and length >= 3:
+                    tempos.append((tick, (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]))
+                pos += length
+                if meta_type == 0x2F:
+                    break
+            elif event in [0xF0, 0xF7]:
+                # System exclusive
+                length, pos = read_varlen(data, pos)
+                pos += length
+            else:
+                # Channel event (running status already handled)
+                kind, channel = status & 0xF0, status & 0x0F
+                if kind in [0xC0, 0xD0]:
+                    if kind == 0xC0:
+                        programs[channel] = data[pos]
+                    pos += 1
+                else:
+                    if kind == 0x90 and data[pos + 1] > 0:
+                        instruments.add((track, channel, programs.get(channel, 0)))
+                    pos += 2
+        end_tick = max(end_tick, tick)
+        pos = end
+    signatures.sort(key=lambda s: s[0])
+    tempos.sort(key=lambda t: t[0])
+    return {'sig': [signatures[0][1], signatures[0][2]] if len(signatures) > 0 else None,
+            'tempo': 60000000. / (tempos[0][1] if len(tempos) > 0 else 500000),
+            'duration': tick_to_time(end_tick, tempos, division),
+            'nb_instruments': len(instruments)}
+
+
+# Convert a tick position to seconds, following the tempo map
+def tick_to_time(tick, tempos, division):
+    if division & 0x8000:
+        # SMPTE division (frames per second times ticks per frame)
+        return tick / float((256 - (division >> 8)) * (division & 0xFF))
+    time, last_tick, tempo = 0., 0, 500000
+    for change_tick, change_tempo in tempos:
+        if change_tick >= tick:
+            break
+        time += (change_tick - last_tick) * tempo / (division * 1000000.)
+        last_tick, tempo = change_tick, change_tempo
+    return time + (tick - last_tick) * tempo / (division * 1000000.)
+
+
+# Check if a scanned file can be kept for a given signature (files without signature are kept)
+def signature_match(header, score_sig):
+    if score_sig == 'all' or header['sig'] is None:
+        return True
+    return header['sig'] == [int(s) for s in score_sig.split('_')]
+
+
+# -----------------------------------------------------------
+#
+# Per-file index of the midi folder
+#
+# -----------------------------------------------------------
+
+def load_midi_index(root_dir):
+    path = os.path.join(root_dir, MIDI_INDEX)
+    if not os.path.exists(path):
+        return None
+    with open(path, 'r') as f:
+        return json.load(f)
+
+
+def midi_index(root_dir, file_names):
+    """
+    Header information of every midi file (signature, tempo, duration, number of
+    instruments), refreshed only for the files whose content changed.
+
+    Returns:
+        dict: entries indexed by file name.
+    """
+    previous = load_midi_index(root_dir)
+    entries = hash_files(root_dir, file_names, previous)
+    old_entries = previous['files'] if previous is not None else {}
+    changed = False
+    for file_name, entry in entries.items():
+        old = old_entries.get(file_name)
+        if old is not None and old['hash'] == entry['hash'] and 'header' in old:
+            entry['header'] = old['header']
+            changed = changed or old['mtime'] != entry['mtime']
+            continue
+        try:
+            entry['header'] = scan_midi(os.path.join(root_dir, file_name))
+        except (ValueError, IndexError, struct.error):
+            # Unreadable headers are left to the full parser
+            entry['header'] = None
+        changed = True
+    if changed or len(old_entries) != len(entries):
+        # Written aside then renamed, as the splits of several jobs may share the folder
+        path = os.path.join(root_dir, MIDI_INDEX)
+        tmp_path = path + '.%d.tmp' % os.getpid()
+        with open(tmp_path, 'w') as f:
+            json.dump({'files': entries}, f)
+        os.replace(tmp_path, path)
+    return entries
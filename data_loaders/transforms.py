@@ -175,4 +175,157 @@ class Transpose(object):
         return data_tr
     
     def __repr__(self):
-        return self.__class__.__name__
\ No newline at end of file
+        return self.__class__.__name__
+
+# -----------------------------------------------------------
+#
+# Batch-level versions (independent random draws for each item of a [B, P, T] batch)
+#
+# -----------------------------------------------------------
+
+class BatchPitchFlip(object):
+    """
+    Flip the pitch axis of the selected items of a batch
+    """
+
+    def __call__(self, data, mask=None):
+        """
+        Args:
+            data (Tensor): Batch of shape [B, P, T]
+            mask (Tensor): Boolean [B] selecting the items to transform (all if None)
+        Returns:
+            Tensor: Transformed batch.
+        """
+        if mask is None:
+            return torch.flip(data, [1])
+        return torch.where(mask[:, None, None], torch.flip(data, [1]), data)
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class BatchTimeFlip(object):
+    """
+    Flip the time axis of the selected items of a batch
+    """
+
+    def __call__(self, data, mask=None):
+        """
+        Args:
+            data (Tensor): Batch of shape [B, P, T]
+            mask (Tensor): Boolean [B] selecting the items to transform (all if None)
+        Returns:
+            Tensor: Transformed batch.
+        """
+        if mask is None:
+            return torch.flip(data, [2])
+        return torch.where(mask[:, None, None], torch.flip(data, [2]), data)
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class BatchMaskRows(object):
+    """
+    Put random rows to zeros (independently for each item)
+
+    Args:
+        factor (int): Percentage to be put to zero. default: .2
+    """
+
+    def __init__(self, factor=.2, dim=1):
+        self.factor = factor
+        self.dim = dim
+
+    def __call__(self, data, mask=None):
+        """
+        Args:
+            data (Tensor): Batch of shape [B, P, T]
+            mask (Tensor): Boolean [B] selecting the items to transform (all if None)
+        Returns:
+            Tensor: Masked batch.
+        """
+        size = data.shape[self.dim]
+        # Draw rows with replacement, as in the per-sample version
+        ids = torch.randint(0, size, (data.shape[0], int(np.floor(size * self.factor))), device=data.device)
+        zeros = torch.zeros(data.shape[0], size, dtype=torch.bool, device=data.device).scatter_(1, ids, True)
+        if mask is not None:
+            zeros &= mask[:, None]
+        zeros = zeros.unsqueeze(3 - self.dim)
+        return data.masked_fill(zeros, 0)
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class BatchMaskColumns(BatchMaskRows):
+    """
+    Put random columns to zeros (independently for each item)
+
+    Args:
+        factor (int): Percentage to be put to zero. default: .2
+    """
+
+    def __init__(self, factor=.2):
+        super(BatchMaskColumns, self).__init__(factor, dim=2)
+
+class BatchTranspose(object):
+    """
+    Transpose each item by a random number of semitones (up or down)
+
+    Args:
+        value (int): Transposition is drawn in [1, value - 1]. default: 11
+    """
+
+    def __init__(self, value=11):
+        self.value = value
+
+    def __call__(self, data, mask=None):
+        """
+        Args:
+            data (Tensor): Batch of shape [B, P, T]
+            mask (Tensor): Boolean [B] selecting the items to transform (all if None)
+        Returns:
+            Tensor: Transposed batch.
+        """
+        n_batch, n_pitch = data.shape[0], data.shape[1]
+        cur_tr = torch.randint(1, self.value, (n_batch,), device=data.device)
+        cur_sign = torch.randint(0, 2, (n_batch,), device=data.device)
+        shift = torch.where(cur_sign > 0, cur_tr, -cur_tr)
+        if mask is not None:
+            shift = shift * mask.long()
+        # Row p of the output reads row p + shift of the input (zeros outside)
+        ids = torch.arange(n_pitch, device=data.device)[None, :] + shift[:, None]
+        valid = (ids >= 0) & (ids < n_pitch)
+        data_tr = torch.gather(data, 1, ids.clamp(0, n_pitch - 1)[:, :, None].expand(-1, -1, data.shape[2]))
+        return data_tr.masked_fill(~valid[:, :, None], 0)
+
+    def __repr__(self):
+        return self.__class__.__name__
+
+class BatchAugment(object):
+    """
+    Batch equivalent of RandomApply([RandomChoice(transforms)], p): each item
+    is transformed with probability p, by one uniformly chosen transform.
+
+    Args:
+        transforms (list): Batch transforms to choose from
+        p (float): Probability to transform an item. default: .5
+    """
+
+    def __init__(self, transforms, p=.5):
+        self.transforms = transforms
+        self.p = p
+
+    def __call__(self, data):
+        """
+        Args:
+            data (Tensor): Batch of shape [B, P, T]
+        Returns:
+            Tensor: Augmented batch.
+        """
+        apply = torch.rand(data.shape[0], device=data.device) < self.p
+        choice = torch.randint(0, len(self.transforms), (data.shape[0],), device=data.device)
+        for i, t in enumerate(self.transforms):
+            data = t(data, apply & (choice == i))
+        return data
+
+    def __repr__(self):
+        return self.__class__.__name__ + '(' + ', '.join([repr(t) for t in self.transforms]) + ')'
@@ -12,7 +12,7 @@ import torch.nn as nn
 import numpy as np
 import random
 import matplotlib.pyplot as plt
-from data_loaders.data_loader import import_dataset
+from data_loaders.data_loader import import_dataset, snapshot_path
 from symbolic import compute_symbolic_features, features
 from utils import LatentDataset, epoch_train, epoch_test, init_classic
 import matplotlib.patches as patches
@@ -58,6 +58,15 @@ parser.add_argument('--data_binarize', type=int, default=1, help='binarize the d
 parser.add_argument('--data_pitch', type=int, default=1, help='constrain pitches in the data')
 parser.add_argument('--data_export', type=int, default=0, help='recompute the dataset (for debug purposes)')
 parser.add_argument('--data_augment', type=int, default=1, help='use data augmentation')
+parser.add_argument('--data_jobs', type=int, default=1, help='number of processes for the export')
+parser.add_argument('--data_pack', type=int, default=0, help='store and load binarized bars as packed bits')
+parser.add_argument('--data_stream', type=int, default=0, help='stream bars from midi (2 = also fill the cache)')
+parser.add_argument('--data_sparse', type=int, default=0, help='load bars as note events rasterized per batch')
+parser.add_argument('--data_memory', type=int, default=0, help='keep all bars in a shared in-memory tensor')
+parser.add_argument('--data_query', type=str, default='', help='SQL condition on the bar index (uses the all_all export, mono = one pitch over all instruments)')
+parser.add_argument('--data_dedupe', type=int, default=0, help='store identical bars once and sample by multiplicity')
+parser.add_argument('--data_dedupe_power', type=float, default=1., help='power on multiplicities (< 1 flattens)')
+parser.add_argument('--data_classes', type=int, default=1, help='serve uint8 class indices to multi-class models')
 parser.add_argument('--num_classes', type=int, default=2, help='number of velocity classes')
 parser.add_argument('--subsample', type=int, default=0, help='train on subset')
 parser.add_argument('--nbworkers', type=int, default=3, help='')
@@ -83,35 +92,25 @@ args.device = torch.device(args.device if torch.cuda.is_available() else 'cpu')
 # Load dataset and compute symbolic features
 #
 # -----------------------------------------------------------
-# Data importing
-data_variants = [args.dataset, args.score_type, args.data_binarize, args.num_classes]
-args.loaders_path = args.output_path + '/loaders_'
-for m in data_variants:
-    args.loaders_path += str(m) + '_'
-args.loaders_path = args.loaders_path[:-1] + '.th'
+# Data importing (loaders are rebuilt from the data snapshot of the experiment)
 print('[Importing dataset]')
-if not os.path.exists(args.loaders_path):
-    # Import dataset from files
-    train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args)
-    # Recall minimum pitch
-    args.min_pitch = train_set.min_p
+train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args, snapshot_path(args))
+# Recall minimum pitch
+args.min_pitch = train_set.min_p
+args.max_pitch = train_set.max_p
+# Symbolic features are cached aside (only tensors)
+args.features_path = snapshot_path(args).replace('/data_', '/features_')
+features_cache = torch.load(args.features_path) if os.path.exists(args.features_path) else {}
+if features_cache.get('data_fingerprint') != args.data_fingerprint:
     # Compute features on all sets
     print('[Computing features]')
     train_features = compute_symbolic_features(train_loader, args)
     valid_features = compute_symbolic_features(valid_loader, args)
     test_features = compute_symbolic_features(test_loader, args)
-    # Save everything as a torch object
-    torch.save([train_loader, valid_loader, test_loader,
-                train_set, valid_set, test_set,
-                train_features, valid_features, test_features], args.loaders_path)
+    torch.save({'data_fingerprint': args.data_fingerprint,
+                'features': [train_features, valid_features, test_features]}, args.features_path)
 else:
-    data = torch.load(args.loaders_path)
-    train_loader, valid_loader, test_loader = data[0], data[1], data[2]
-    train_set, valid_set, test_set = data[3], data[4], data[5]
-    train_features, valid_features, test_features = data[6], data[7], data[8]
-    # Recall minimum pitch
-    args.min_pitch = train_set.min_p
-    args.max_pitch = train_set.max_p
+    train_features, valid_features, test_features = features_cache['features']
 
 # %% ---------------------------------------------------------
 #
@@ -129,6 +128,9 @@ if len(args.model_path) == 0:
     args.model_path = args.model_path[:-1] + '/'
 # Reload best performing model
 model = torch.load(args.model_path + 'models/_full.pth', map_location=args.device)
+# Check that the model was trained on the same data
+if getattr(model, 'data_fingerprint', None) not in [None, args.data_fingerprint]:
+    print('[Warning: model was trained on different data (fingerprint mismatch)]')
 
 
 # %% ---------------------------------------------------------
@@ -145,7 +147,7 @@ def compute_latent(model, loader, args):
     with torch.no_grad():
         for x in loader:
             # Send to device
-            x = x.to(args.device, non_blocking=True)
+            x = loader.dataset.unpack(x.to(args.device, non_blocking=True))
             # Encode into model
             latent, mu, var = model.encode(x)
             latent_set.append(latent.detach())
@@ -41,8 +41,8 @@ class Learn:
         self.recon_loss_mean = torch.zeros(1).to(args.device)
         self.kl_div_mean = torch.zeros(1).to(args.device)
         for batch_idx, x in tqdm(enumerate(self.train_loader), total=len(self.train_set) // args.batch_size):
-            # Send to device
-            x = x.to(args.device, non_blocking=True)
+            # Send to device (and unpack at the model boundary)
+            x = self.train_set.unpack(x.to(args.device, non_blocking=True))
             # Pass into model
             x_recon, latent, z_loss = model(x)
             # Turn into index vector (multinouli)
@@ -83,7 +83,7 @@ class Learn:
         with torch.no_grad():
             for batch_idx, x in tqdm(enumerate(self.validate_loader), total=len(self.validate_set) // args.batch_size):
                 # Send to device
-                x = x.to(args.device)
+                x = self.validate_set.unpack(x.to(args.device))
                 # Pass into model
                 x_recon, latent, z_loss = model(x)
                 # Turn into index vector
@@ -111,7 +111,7 @@ class Learn:
         self.recon_loss_mean_test = torch.zeros(1).to(args.device)
         with torch.no_grad():
             for batch_idx, x in tqdm(enumerate(self.test_loader), total=len(self.test_set) // args.batch_size):
-                x = x.to(args.device)
+                x = self.test_set.unpack(x.to(args.device))
                 # Pass into model
                 x_recon, latent, z_loss = model(x)
                 # Turn into index vector
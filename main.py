@@ -8,12 +8,12 @@ from time import time
 from texttable import Texttable
 # Personnal imports
 from learn import Learn
-from data_loaders.data_loader import import_dataset
+from data_loaders.data_loader import import_dataset, snapshot_path
 from reconstruction import reconstruction, sampling, interpolation
 # Import encoders
 from models.encoders import EncoderMLP, DecoderMLP, EncoderCNN, DecoderCNN
 from models.encoders import EncoderGRU, DecoderGRU, EncoderCNNGRU, DecoderCNNGRU, DecoderCNNGRUEmbedded
-from models.encoders import EncoderHierarchical, DecoderHierarchical
+from models.encoders import EncoderHierarchical, DecoderHierarchical, DecoderParallel
 # Import model variants
 from models.ae import AE, VAE, WAE
 # Import initializer
@@ -43,11 +43,20 @@ parser.add_argument('--data_binarize',  type=int, default=1,            help='bi
 parser.add_argument('--data_pitch',     type=int, default=1,            help='constrain pitches in the data')
 parser.add_argument('--data_export',    type=int, default=0,            help='recompute the dataset (for debug purposes)')
 parser.add_argument('--data_augment',   type=int, default=1,            help='use data augmentation')
+parser.add_argument('--data_jobs',      type=int, default=1,            help='number of processes for the export')
+parser.add_argument('--data_pack',      type=int, default=0,            help='store and load binarized bars as packed bits')
+parser.add_argument('--data_stream',    type=int, default=0,            help='stream bars from midi (2 = also fill the cache)')
+parser.add_argument('--data_sparse',    type=int, default=0,            help='load bars as note events rasterized per batch')
+parser.add_argument('--data_memory',    type=int, default=0,            help='keep all bars in a shared in-memory tensor')
+parser.add_argument('--data_query',     type=str, default='',           help='SQL condition on the bar index (uses the all_all export, mono = one pitch over all instruments)')
+parser.add_argument('--data_dedupe',    type=int, default=0,            help='store identical bars once and sample by multiplicity')
+parser.add_argument('--data_dedupe_power', type=float, default=1.,      help='power on multiplicities (< 1 flattens)')
+parser.add_argument('--data_classes',   type=int, default=1,            help='serve uint8 class indices to multi-class models')
 # Model Saving and reconstruction
 parser.add_argument('--output_path',    type=str, default='output/', help='major path for data output')
 # Model Parameters
 parser.add_argument("--model",          type=str, default="vae",        help='ae | vae | vae-flow | wae')
-parser.add_argument("--encoder_type",   type=str, default="cnn-gru",    help='mlp | cnn | res-cnn | gru | cnn-gru | hierarchical')
+parser.add_argument("--encoder_type",   type=str, default="cnn-gru",    help='mlp | cnn | res-cnn | gru | cnn-gru | hierarchical | cnn-parallel')
 parser.add_argument("--beta",           type=float, default=2.,         help='value of beta regularization')
 parser.add_argument("--beta_delay",     type=int, default=0,            help='delay before using beta')
 # PyraPro and vae_mathieu specific parameters: dimensions of the architecture
@@ -58,7 +67,9 @@ parser.add_argument('--cond_output_dim', type=int, default=512,         help='do
 parser.add_argument('--dec_hidden_size', type=int, default=512,         help='do not touch if you do not know')
 parser.add_argument('--num_layers',     type=int, default=2,            help='do not touch if you do not know')
 parser.add_argument('--num_subsequences', type=int, default=8,          help='do not touch if you do not know')
+parser.add_argument('--subseq_mode',    type=str, default='sequential', help='sequential | independent (hierarchical subsequences decoded in parallel)')
 parser.add_argument('--num_classes',    type=int, default=2,            help='number of velocity classes')
+parser.add_argument('--teacher_forcing', type=str, default='scheduled', help='scheduled | full (always teacher forced, fused decoding in training)')
 parser.add_argument('--initialize',     type=int, default=0,            help='use initialization on the model')
 # Optimization parameters
 parser.add_argument('--batch_size',     type=int, default=64,           help='input batch size')
@@ -127,7 +138,7 @@ if args.data_binarize and args.num_classes > 1:
 # -----------------------------------------------------------
 # Data importing
 print('[Importing dataset]')
-train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args)
+train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = import_dataset(args, snapshot_path(args))
 args.min_pitch = test_set.min_p
 
 # %%
@@ -168,6 +179,11 @@ elif args.encoder_type == 'cnn-gru-embed':
 elif args.encoder_type == 'hierarchical':
     encoder = EncoderHierarchical(args)
     decoder = DecoderHierarchical(args)
+elif args.encoder_type == 'cnn-parallel':
+    args.type_mod = 'normal'
+    encoder = EncoderCNNGRU(args)
+    args.cnn_size = encoder.cnn_size
+    decoder = DecoderParallel(args)
 print('[Creating model]')
 # Then select different models
 if args.model == 'ae':
@@ -179,6 +195,8 @@ elif args.model == 'wae':
 else:
     print("Oh no, unknown model " + args.model + ".\n")
     exit()
+# Keep track of the data used for training (saved with the checkpoints)
+model.data_fingerprint = args.data_fingerprint
 # Send model to the device
 model.to(args.device)
 # Initialize the model weights
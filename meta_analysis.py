@@ -1,4 +1,5 @@
 import os
+import glob
 import torch
 import argparse
 import numpy as np
@@ -6,6 +7,7 @@ import matplotlib.pyplot as plt
 from texttable import Texttable
 import seaborn as sns
 import pandas
+from data_loaders.data_loader import DataSnapshot
 
 # Beautify the plots
 large = 26; med = 18; small = 12
@@ -36,6 +38,7 @@ parser.add_argument('--data_augment',   type=int, default=1,            help='us
 parser.add_argument('--num_classes',    type=int, default=2,            help='number of velocity classes')
 # Model Saving and reconstruction
 parser.add_argument('--output_path', type=str, default='output_hpc/', help='major path for data output')
+parser.add_argument('--data_snapshot', type=str, default='', help='data snapshot of main.py (default: latest output/data_<dataset>_*.th)')
 # Model Parameters
 parser.add_argument("--model", type=str, default="vae", help='ae | vae | vae-flow | wae')
 parser.add_argument("--beta", type=float, default=1., help='value of beta regularization')
@@ -225,7 +228,8 @@ import matplotlib.patches as patches
 def interpolation(args, model, dataset, x_a=None, x_b=None, output='output/', fs=25, program=0):
     if (x_a is None):
         x_a, x_b = dataset[random.randint(0, len(dataset) - 1)], dataset[random.randint(0, len(dataset) - 1)]
-        x_a, x_b = x_a.to(args.device), x_b.to(args.device)
+    # Packed bits or class indices are turned into the model inputs
+    x_a, x_b = dataset.unpack(x_a.to(args.device)), dataset.unpack(x_b.to(args.device))
     # Encode samples to the latent space
     z_a, z_b = model.encode(x_a.unsqueeze(0)), model.encode(x_b.unsqueeze(0))
     # Run through alpha values
@@ -305,10 +309,11 @@ def interpolation(args, model, dataset, x_a=None, x_b=None, output='output/', fs
     pm.write(output + "_interpolation.mid")
 
 # Here cheat a little
-data = torch.load('output/loaders_nottingham_mono_1_2.th')
-train_loader, valid_loader, test_loader = data[0], data[1], data[2]
-train_set, valid_set, test_set = data[3], data[4], data[5]
-train_features, valid_features, test_features = data[6], data[7], data[8]
+args.batch_size, args.nbworkers = 64, 0
+if not args.data_snapshot:
+    args.data_snapshot = max(glob.glob('output/data_' + args.dataset + '_*.th'), key=os.path.getmtime)
+data_snapshot = DataSnapshot.load(args.data_snapshot)
+train_loader, valid_loader, test_loader, train_set, valid_set, test_set, args = data_snapshot.restore(args)
 # Recall minimum pitch
 args.min_pitch = train_set.min_p
 # Change args
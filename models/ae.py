@@ -22,10 +22,12 @@ class AE(nn.Module):
         self.input_size = args.input_size[0]
         self.map_latent = nn.Linear(args.enc_hidden_size, args.latent_size)
         self.loss = torch.Tensor(1).zero_().to(args.device)
+        # One-hot rows looked up from class indices
+        self.register_buffer('classes', torch.eye(max(args.num_classes, 1)))
 
     def encode(self, x):
-        # Re-arrange to put time first
-        x = x.transpose(1, 2)
+        # Re-arrange to put time first (class indices are taken as values)
+        x = x.transpose(1, 2).float()
         x = self.encoder(x)
         x = self.map_latent(x)
         return x, x, x
@@ -34,14 +36,16 @@ class AE(nn.Module):
         recon = self.decoder(z)
         recon = recon.transpose(1, 2)
         if self.num_classes > 1:
-            recon = recon.view(z.shape[0], self.num_classes, self.input_size, -1)
+            # Contiguous class maps (required by the NLL backward)
+            recon = recon.contiguous().view(z.shape[0], self.num_classes, self.input_size, -1)
         return recon
 
     def forward(self, x):
         b, c, s = x.size()
         if self.training:
             if self.num_classes > 1:
-                self.sample = torch.nn.functional.one_hot(x.long())
+                # Teacher-forcing inputs as an embedding lookup of the (uint8) class indices
+                self.sample = torch.nn.functional.embedding(x.int(), self.classes)
                 self.sample = self.sample.view(b, s, -1)
             else:
                 self.sample = x
@@ -71,6 +75,8 @@ class VAE(nn.Module):
         self.input_size = args.input_size[0]
         self.linear_mu = nn.Linear(args.enc_hidden_size, args.latent_size)
         self.linear_var = nn.Linear(args.enc_hidden_size, args.latent_size)
+        # One-hot rows looked up from class indices
+        self.register_buffer('classes', torch.eye(max(args.num_classes, 1)))
 
     # Generate bar from latent space
     def generate(self, z):
@@ -79,8 +85,8 @@ class VAE(nn.Module):
         return generated_bar
 
     def encode(self, x):
-        # Re-arrange to put time first
-        x = x.transpose(1, 2)
+        # Re-arrange to put time first (class indices are taken as values)
+        x = x.transpose(1, 2).float()
         out = self.encoder(x)
         mu = self.linear_mu(out)
         var = self.linear_var(out).exp_()
@@ -100,14 +106,16 @@ class VAE(nn.Module):
         recon = self.decoder(z)
         recon = recon.transpose(1, 2)
         if self.num_classes > 1:
-            recon = recon.view(z.shape[0], self.num_classes, self.input_size, -1)
+            # Contiguous class maps (required by the NLL backward)
+            recon = recon.contiguous().view(z.shape[0], self.num_classes, self.input_size, -1)
         return recon
 
     def forward(self, x):
         b, c, s = x.size()
         if self.training:
             if self.num_classes > 1:
-                self.sample = torch.nn.functional.one_hot(x.long())
+                # Teacher-forcing inputs as an embedding lookup of the (uint8) class indices
+                self.sample = torch.nn.functional.embedding(x.int(), self.classes)
                 self.sample = self.sample.view(b, s, -1)
             else:
                 self.sample = x
@@ -5,7 +5,7 @@ from torch.nn import functional as F
 import torch.nn.init as init
 import random
 import numpy as np
-from models.layers import GatedDense, ResConv2d, ResConvTranspose2d
+from models.layers import GatedDense, ResConv2d, ResConvTranspose2d, ScheduledSampling, gru_sequence, step_norm
 
 
 # -----------------------------------------------------------
@@ -500,7 +500,8 @@ class DecoderGRU(nn.Module):
         self.grucell_2 = nn.GRUCell(args.dec_hidden_size, args.dec_hidden_size)
         self.linear_init_1 = nn.Linear(args.latent_size, args.dec_hidden_size)
         self.linear_out_1 = nn.Linear(args.dec_hidden_size, args.input_size[0] * args.num_classes)
-        self.k = torch.FloatTensor([k])
+        # Teacher forcing in training (scheduled | full)
+        self.schedule = ScheduledSampling(k, getattr(args, 'teacher_forcing', 'scheduled'))
         self.eps = 1
         self.iteration = 0
         self.n_step = args.input_size[1]
@@ -531,6 +532,13 @@ class DecoderGRU(nn.Module):
         return x.view(x.shape[0], -1)
 
     def forward(self, z):
+        if self.training:
+            self.eps = self.schedule.update(self.iteration)
+            # Fused decoding only when always teacher forced (--teacher_forcing full)
+            if self.schedule.mode == 'full':
+                return self.forward_teacher(z)
+            # Teacher forcing decisions of all the items and steps (drawn at once)
+            forced = self.schedule.mask(z.size(0), self.n_step, z.device)
         out = torch.zeros((z.size(0), (self.input_size * self.num_classes)))
         out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -548,17 +556,27 @@ class DecoderGRU(nn.Module):
                 out = F.log_softmax(tmp_out.view(z.size(0), self.num_classes, -1), 1).view(z.size(0), -1)
             x.append(out)
             if self.training:
-                p = torch.rand(1).item()
-                if p < self.eps:
-                    out = self.sample[:, i, :]
-                else:
-                    out = self._sampling(out)
-                self.eps = self.k / \
-                           (self.k + torch.exp(float(self.iteration) / self.k))
+                out = self.schedule.blend(forced[:, i], self.sample[:, i, :], self._sampling(out))
             else:
                 out = self._sampling(out)
         return torch.stack(x, 1)
 
+    # Fully teacher-forced decoding: inputs are all known, so each layer runs over the whole sequence at once
+    def forward_teacher(self, z):
+        b = z.size(0)
+        # Start token, then the ground truth of the previous steps
+        start = torch.zeros((b, 1, self.input_size * self.num_classes), device=z.device)
+        start[:, :, -1] = 1.
+        tokens = torch.cat([start, self.sample[:, :self.n_step - 1, :].float()], 1)
+        tokens = torch.cat([tokens, z.unsqueeze(1).expand(-1, self.n_step, -1)], 2)
+        h_1 = gru_sequence(self.grucell_1, tokens, torch.tanh(self.linear_init_1(z)))
+        # The second layer starts from the first state of the first one (as in the step-wise version)
+        h_2 = gru_sequence(self.grucell_2, h_1, h_1[:, 0])
+        out = self.linear_out_1(h_2)
+        if self.num_classes > 1:
+            out = F.log_softmax(out.view(b, self.n_step, self.num_classes, -1), 2).view(b, self.n_step, -1)
+        return out
+
 
 # -----------------------------------------------------------
 #
@@ -578,7 +596,8 @@ class DecoderCNNGRU(nn.Module):
         self.linear_out_1 = nn.Linear(args.dec_hidden_size, args.cnn_size[1])
         self.bnorm = nn.BatchNorm1d(args.cnn_size[1])
         self.linear_out_2 = nn.Linear(args.cnn_size[1], (args.input_size[0] * args.num_classes))
-        self.k = torch.FloatTensor([k])
+        # Teacher forcing in training (scheduled | full)
+        self.schedule = ScheduledSampling(k, getattr(args, 'teacher_forcing', 'scheduled'))
         self.eps = 1
         self.iteration = 0
         self.n_step = args.cnn_size[0]
@@ -637,6 +656,13 @@ class DecoderCNNGRU(nn.Module):
         return x.view(x.shape[0], -1)
 
     def forward(self, z):
+        if self.training:
+            self.eps = self.schedule.update(self.iteration)
+            # Fused decoding only when always teacher forced (--teacher_forcing full)
+            if self.schedule.mode == 'full':
+                return self._decode_cnn(self.forward_teacher(z))
+            forced = self.schedule.mask(z.size(0), self.n_step, z.device)
+            steps = self._truth_steps()
         tmp_out = torch.zeros((z.size(0), (self.input_size * self.num_classes)))
         x, hx = [], [None, None]
         t = torch.tanh(self.linear_init_1(z))
@@ -649,23 +675,38 @@ class DecoderCNNGRU(nn.Module):
                 hx[1] = hx[0]
             hx[1] = self.grucell_2(hx[0], hx[1])
             out = self.linear_out_1(hx[1])
+            x.append(out)
             # WARNING This is the black spot of the model (non-direct teacher forcing)
+            # Only the next token is needed here (its argmax does not need the log_softmax)
             tmp_out = self.linear_out_2(self.bnorm(F.relu(out)))
-            if self.num_classes > 1:
-                tmp_out = F.log_softmax(tmp_out.view(z.size(0), self.num_classes, -1), 1).view(z.size(0), -1)
-            x.append(out)
             if self.training:
-                p = torch.rand(1).item()
-                if p < self.eps:
-                    # WARNING This is the black spot of the model (non-direct teacher forcing)
-                    tmp_out = self.sample[:, int(i * (self.sample.shape[1] / self.n_step)), :]
-                else:
-                    tmp_out = self._sampling(tmp_out)
-                self.eps = self.k / \
-                           (self.k + torch.exp(float(self.iteration) / self.k))
+                tmp_out = self.schedule.blend(forced[:, i], self.sample[:, steps[i], :], self._sampling(tmp_out))
             else:
                 tmp_out = self._sampling(tmp_out)
-        out = torch.stack(x, 1)
+        return self._decode_cnn(torch.stack(x, 1))
+
+    # Ground truth frame fed after each step (the recurrence runs on the time axis of the encoder CNN)
+    def _truth_steps(self):
+        return [int(i * (self.sample.shape[1] / self.n_step)) for i in range(self.n_step)]
+
+    # Fully teacher-forced decoding: the recurrent states of all the steps are computed first
+    def forward_teacher(self, z):
+        b = z.size(0)
+        # Empty start token, then the ground truth of the previous steps
+        start = torch.zeros((b, 1, self.input_size * self.num_classes), device=z.device)
+        tokens = torch.cat([start, self.sample[:, self._truth_steps()[:-1], :].float()], 1)
+        tokens = torch.cat([tokens, z.unsqueeze(1).expand(-1, self.n_step, -1)], 2)
+        h_1 = gru_sequence(self.grucell_1, tokens, torch.tanh(self.linear_init_1(z)))
+        h_2 = gru_sequence(self.grucell_2, h_1, h_1[:, 0])
+        out = self.linear_out_1(h_2)
+        # The fed tokens are all known, the token head only keeps its running statistics (used when free running),
+        # updated on each step as in the step-wise decoding
+        with torch.no_grad():
+            step_norm(self.bnorm, F.relu(out.transpose(0, 1).reshape(-1, out.shape[2])), self.n_step)
+        return out
+
+    # Transposed CNN applied once to the states of all the steps
+    def _decode_cnn(self, out):
         out = out.view(-1, self.cnn_size[0], self.cnn_size[1])
         out = out.unsqueeze(1).view(-1, 1, self.cnn_size[0], self.cnn_size[1])
         for m in range(len(self.net)):
@@ -693,7 +734,8 @@ class DecoderCNNGRUEmbedded(nn.Module):
         self.grucell_2 = nn.GRUCell(args.dec_hidden_size, args.dec_hidden_size)
         self.linear_init_1 = nn.Linear(args.latent_size, args.dec_hidden_size)
         self.linear_out_1 = nn.Linear(args.dec_hidden_size, args.cnn_size[1] * 4)
-        self.k = torch.FloatTensor([k])
+        # Teacher forcing in training (scheduled | full)
+        self.schedule = ScheduledSampling(k, getattr(args, 'teacher_forcing', 'scheduled'))
         self.eps = 1
         self.iteration = 0
         self.n_step = args.input_size[1]
@@ -752,6 +794,12 @@ class DecoderCNNGRUEmbedded(nn.Module):
         return x.view(x.shape[0], -1)
 
     def forward(self, z):
+        if self.training:
+            self.eps = self.schedule.update(self.iteration)
+            # Fused decoding only when always teacher forced (--teacher_forcing full)
+            if self.schedule.mode == 'full':
+                return self._output(self.forward_teacher(z))
+            forced = self.schedule.mask(z.size(0), self.n_step, z.device)
         out = torch.zeros((z.size(0), (self.input_size * self.num_classes)))
         #out[:, -1] = 1.
         x, hx = [], [None, None]
@@ -764,24 +812,45 @@ class DecoderCNNGRUEmbedded(nn.Module):
             if i == 0:
                 hx[1] = hx[0]
             hx[1] = self.grucell_2(hx[0], hx[1])
-            out = self.linear_out_1(hx[1])
-            out = out.view(out.shape[0], 4, -1).unsqueeze(1)
-            for m in range(len(self.net)):
-                out = self.net[m](out)
-            if self.num_classes > 1:
-                out = F.log_softmax(torch.mean(out, dim=2).view(z.size(0), self.num_classes, -1), 1).view(z.size(0), -1)
+            out = self._embed(self.linear_out_1(hx[1]))
             x.append(out)
             if self.training:
-                p = torch.rand(1).item()
-                if p < self.eps:
-                    out = self.sample[:, i, :]
-                else:
-                    out = self._sampling(out)
-                self.eps = self.k / \
-                           (self.k + torch.exp(float(self.iteration) / self.k))
+                out = self.schedule.blend(forced[:, i], self.sample[:, i, :], self._sampling(out))
             else:
                 out = self._sampling(out)
-        out = torch.stack(x, 1)
+        return self._output(torch.stack(x, 1))
+
+    # Fully teacher-forced decoding: the CNN runs once on the states of all the steps ([B*T, 1, 4, cnn])
+    def forward_teacher(self, z):
+        b = z.size(0)
+        # Empty start token, then the ground truth of the previous steps
+        start = torch.zeros((b, 1, self.input_size * self.num_classes), device=z.device)
+        tokens = torch.cat([start, self.sample[:, :self.n_step - 1, :].float()], 1)
+        tokens = torch.cat([tokens, z.unsqueeze(1).expand(-1, self.n_step, -1)], 2)
+        h_1 = gru_sequence(self.grucell_1, tokens, torch.tanh(self.linear_init_1(z)))
+        h_2 = gru_sequence(self.grucell_2, h_1, h_1[:, 0])
+        # Steps are stacked step-major ([T * B]), so that each step is a contiguous batch of B rows
+        out = self.linear_out_1(h_2.transpose(0, 1).reshape(self.n_step * b, -1))
+        out = self._embed(out, self.n_step)
+        return out.view(self.n_step, b, -1).transpose(0, 1).contiguous()
+
+    # Frame distributions from the recurrent states (n_step stacked batches of steps)
+    def _embed(self, out, n_step=1):
+        n = out.shape[0]
+        out = out.view(n, 4, -1).unsqueeze(1)
+        for m in self.net:
+            # Convolutions run once, batch normalizations on each step (same statistics as the step-wise decoding)
+            if isinstance(m, nn.BatchNorm2d):
+                out = step_norm(m, out, n_step)
+            elif isinstance(m, ResConvTranspose2d):
+                out = m(out, n_step)
+            else:
+                out = m(out)
+        if self.num_classes > 1:
+            out = F.log_softmax(torch.mean(out, dim=2).view(n, self.num_classes, -1), 1).view(n, -1)
+        return out
+
+    def _output(self, out):
         out = out.view(out.shape[0], self.num_classes, self.n_step, -1)
         if len(self.out_size) < 3 or self.num_classes < 2:
             out = out.squeeze(1)
@@ -808,6 +877,9 @@ class DecoderHierarchical(nn.Module):
         self.num_layers = args.num_layers
         self.seq_length = args.input_size[1]
         self.subseq_size = self.seq_length // self.num_subsequences
+        # Subsequences chained by their boundary tokens (sequential) or each started from
+        # an empty token (independent, decoded in parallel also at inference)
+        self.subseq_mode = getattr(args, 'subseq_mode', 'sequential')
         self.teacher_forcing_ratio = 0.5
         self.tanh = nn.Tanh()
         self.sigmoid = torch.nn.Sigmoid()
@@ -823,11 +895,17 @@ class DecoderHierarchical(nn.Module):
         # bidirectional=False, dropout=0.6)
         self.decoder_output = nn.Linear(args.dec_hidden_size, self.input_size * args.num_classes)
         self.num_classes = args.num_classes
-        self.k = torch.FloatTensor([k])
+        # Teacher forcing in training (scheduled | full)
+        self.schedule = ScheduledSampling(k, getattr(args, 'teacher_forcing', 'scheduled'))
         self.eps = 1
         self.iteration = 0
         self.init_parameters()
 
+    def __setstate__(self, state):
+        super(DecoderHierarchical, self).__setstate__(state)
+        # Models saved before the subsequence modes decode sequentially
+        self.__dict__.setdefault('subseq_mode', 'sequential')
+
     def init_parameters(self):
         """ Initialize internal parameters (sub-modules) """
         for m in self.modules():
@@ -852,6 +930,10 @@ class DecoderHierarchical(nn.Module):
 
     def forward(self, latent):
         batch_size = latent.shape[0]
+        forced = None
+        if self.training:
+            self.eps = self.schedule.update(self.iteration)
+            forced = self.schedule.mask(batch_size, self.seq_length, latent.device)
         # Get the initial state of the conductor
         h0_cond = self.tanh(self.fc_init_cond(latent)).view(self.num_layers, batch_size, -1).contiguous()
         # Divide the latent code in subsequences
@@ -862,6 +944,11 @@ class DecoderHierarchical(nn.Module):
         # Get the initial states of the decoder
         h0s_dec = self.tanh(self.fc_init_dec(subseq_embeddings)).view(self.num_layers, batch_size,
                                                                       self.num_subsequences, -1).contiguous()
+        # Always teacher forced (--teacher_forcing full): subsequences are decoded at once
+        if self.training and self.schedule.mode == 'full':
+            return self.forward_teacher(subseq_embeddings, h0s_dec)
+        if self.subseq_mode == 'independent':
+            return self.forward_parallel(subseq_embeddings, h0s_dec, forced)
         # init the output seq and the first token to 0 tensors
         out = []
         token = torch.zeros(batch_size, (self.input_size * self.num_classes), dtype=torch.float, device=self.device)
@@ -880,13 +967,102 @@ class DecoderHierarchical(nn.Module):
                 # Fill the out tensor with the token
                 out.append(token)
                 if self.training:
-                    p = torch.rand(1).item()
-                    if p < self.eps:
-                        token = self.sample[:, i, :]
-                    else:
-                        token = self._sampling(token)
-                    self.eps = self.k / \
-                               (self.k + torch.exp(float(self.iteration) / self.k))
+                    step = sub * self.subseq_size + i
+                    token = self.schedule.blend(forced[:, step], self.sample[:, step, :], self._sampling(token))
                 else:
                     token = self._sampling(token)
         return torch.stack(out, 1)
+
+    # Subsequences folded in the batch: [B, N, ...] -> [B * N, ...]
+    def _fold(self, x):
+        return x.reshape(x.shape[0] * self.num_subsequences, *x.shape[2:])
+
+    # First token of each subsequence, given the input tokens of all the steps [B, T, F]
+    def _first_tokens(self, tokens):
+        tokens = tokens.view(tokens.shape[0], self.num_subsequences, self.subseq_size, -1)
+        if self.subseq_mode == 'independent':
+            tokens = torch.cat([torch.zeros_like(tokens[:, :, :1]), tokens[:, :, 1:]], 2)
+        return self._fold(tokens)
+
+    def _log_softmax(self, token):
+        if self.num_classes > 1:
+            token = F.log_softmax(token.view(token.shape[0], self.num_classes, -1), 1).view(token.shape[0], -1)
+        return token
+
+    def forward_teacher(self, subseq_embeddings, h0s_dec):
+        """ Teacher-forced decoding of all the subsequences at once (single fused sequence call) """
+        batch_size = subseq_embeddings.shape[0]
+        # Inputs are the ground truth of the previous steps (empty token at the start)
+        tokens = torch.cat([torch.zeros_like(self.sample[:, :1, :]), self.sample[:, :-1, :]], 1).float()
+        tokens = self._first_tokens(tokens)
+        embeddings = self._fold(subseq_embeddings).unsqueeze(1).expand(-1, self.subseq_size, -1)
+        h_dec = gru_sequence(self.decoder_RNN, torch.cat((tokens, embeddings), 2), self._fold(torch.mean(h0s_dec, 0)))
+        out = self._log_softmax(self.decoder_output(h_dec).view(-1, self.input_size * self.num_classes))
+        return out.view(batch_size, self.seq_length, -1)
+
+    def forward_parallel(self, subseq_embeddings, h0s_dec, forced=None):
+        """ Decode independent subsequences concurrently (subseq_size sequential steps) """
+        batch_size = subseq_embeddings.shape[0]
+        embeddings = self._fold(subseq_embeddings)
+        h_dec = self._fold(torch.mean(h0s_dec, 0))
+        token = torch.zeros(embeddings.shape[0], (self.input_size * self.num_classes), device=embeddings.device)
+        if forced is not None:
+            forced = forced.view(batch_size * self.num_subsequences, self.subseq_size)
+            truth = self.sample.reshape(batch_size * self.num_subsequences, self.subseq_size, -1)
+        out = []
+        for i in range(self.subseq_size):
+            h_dec = self.decoder_RNN(torch.cat((token.float(), embeddings), 1), h_dec)
+            token = self._log_softmax(self.decoder_output(h_dec))
+            out.append(token)
+            if forced is not None:
+                token = self.schedule.blend(forced[:, i], truth[:, i, :], self._sampling(token))
+            else:
+                token = self._sampling(token)
+        return torch.stack(out, 1).view(batch_size, self.seq_length, -1)
+
+# -----------------------------------------------------------
+#
+# Non-autoregressive decoder (all frames predicted in parallel)
+#
+# -----------------------------------------------------------
+
+
+class DecoderParallel(nn.Module):
+    """
+    Predict all the frames of a bar at once: each time position has a learned
+    embedding, shifted by a projection of z, and positions attend to each other
+    through a stack of self-attention layers (no recurrence nor teacher forcing).
+
+    Args:
+        n_layers (int): number of self-attention layers. default: 4
+        n_heads (int): number of attention heads (must divide dec_hidden_size). default: 8
+    """
+
+    def __init__(self, args, n_layers=4, n_heads=8, dropout=.1):
+        super(DecoderParallel, self).__init__()
+        hidden_size = args.dec_hidden_size
+        self.n_step = args.input_size[1]
+        self.input_size = args.input_size[0]
+        self.num_classes = args.num_classes
+        self.iteration = 0
+        self.positions = nn.Parameter(torch.zeros(self.n_step, hidden_size))
+        self.linear_init_1 = nn.Linear(args.latent_size, hidden_size)
+        layer = nn.TransformerEncoderLayer(hidden_size, n_heads, hidden_size * 2, dropout, batch_first=True)
+        self.net = nn.TransformerEncoder(layer, n_layers)
+        self.linear_out_1 = nn.Linear(hidden_size, self.input_size * self.num_classes)
+        self.init_parameters()
+
+    def init_parameters(self):
+        """ Initialize internal parameters (sub-modules) """
+        init.normal_(self.positions.data, std=0.02)
+        for m in [self.linear_init_1, self.linear_out_1]:
+            init.xavier_normal_(m.weight.data)
+            init.normal_(m.bias.data)
+
+    def forward(self, z):
+        # Every position sees the latent code ([B, T, hidden])
+        out = self.positions.unsqueeze(0) + self.linear_init_1(z).unsqueeze(1)
+        out = self.linear_out_1(self.net(out))
+        if self.num_classes > 1:
+            out = F.log_softmax(out.view(z.size(0), self.n_step, self.num_classes, -1), 2)
+        return out.reshape(z.size(0), self.n_step, -1)
@@ -1,5 +1,6 @@
 # -*- coding: utf-8 -*-
 
+import math
 import torch
 import torch.nn as nn
 
@@ -52,6 +53,12 @@ class ResConv2d(nn.Module):
         g = self.g(x)
         return h + g
 
+# Batch normalization of n_step stacked batches, each with its own statistics (as if they were normalized in turn)
+def step_norm(bn, x, n_step=1):
+    if n_step == 1:
+        return bn(x)
+    return torch.cat([bn(x_step) for x_step in x.chunk(n_step)])
+
 class ResConvTranspose2d(nn.Module):
     
     def __init__(self, in_c, out_c, kernel, stride, pad, output_padding=0, dilation=1, act=torch.relu):
@@ -67,8 +74,8 @@ class ResConvTranspose2d(nn.Module):
         self.g.weight.requires_grad = False
         self.g.bias.requires_grad = False
 
-    def forward(self, x):
-        h = self.activation(self.bn(self.h(x)))
+    def forward(self, x, n_step=1):
+        h = self.activation(step_norm(self.bn, self.h(x), n_step))
         g = self.g(x)
         return h + g
     
@@ -84,4 +91,75 @@ class GatedConvTranspose2d(nn.Module):
     def forward(self, x):
         h = self.activation(self.h(x))
         g = self.sigmoid(self.g(x))
-        return h * g
\ No newline at end of file
+        return h * g
+
+
+# GRU layers (one per layout, device and type) only used as templates to run the weights of GRUCells, their own weights are unused
+_SEQUENCE_GRUS = {}
+
+
+def gru_sequence(cell, x, h0):
+    """
+    Run a GRUCell over a whole sequence in a single fused call (same parameters
+    and outputs as calling the cell at each step).
+
+    Args:
+        cell (nn.GRUCell): cell holding the parameters
+        x (Tensor): inputs of shape [B, T, input_size]
+        h0 (Tensor): initial state of shape [B, hidden_size]
+    Returns:
+        Tensor: states at each step, of shape [B, T, hidden_size]
+    """
+    key = (cell.input_size, cell.hidden_size, cell.bias, cell.weight_ih.device, cell.weight_ih.dtype)
+    if key not in _SEQUENCE_GRUS:
+        _SEQUENCE_GRUS[key] = nn.GRU(cell.input_size, cell.hidden_size, bias=cell.bias, batch_first=True,
+                                     device=cell.weight_ih.device, dtype=cell.weight_ih.dtype)
+    params = {'weight_ih_l0': cell.weight_ih, 'weight_hh_l0': cell.weight_hh}
+    if cell.bias:
+        params.update({'bias_ih_l0': cell.bias_ih, 'bias_hh_l0': cell.bias_hh})
+    out, _ = torch.func.functional_call(_SEQUENCE_GRUS[key], params, (x, h0.unsqueeze(0).contiguous()))
+    return out
+
+
+class ScheduledSampling(object):
+    """
+    Teacher forcing schedule of the recurrent decoders. The probability eps of
+    feeding the ground truth decays with the training iterations (inverse sigmoid),
+    and the decisions of a whole batch (one per item and step) are drawn at once.
+
+    Args:
+        k (float): decay constant of the schedule. default: 500
+        mode (str): 'scheduled' or 'full' (always feed the ground truth, the decoders then run their fused
+            teacher-forced path). default: 'scheduled'
+    """
+
+    def __init__(self, k=500, mode='scheduled'):
+        self.k = float(k)
+        self.mode = mode
+        self.eps = 1.
+
+    def update(self, iteration):
+        """ Compute eps for an iteration (once, as a Python float) """
+        self.eps = self.k / (self.k + math.exp(min(iteration / self.k, 700.)))
+        return self.eps
+
+    def mask(self, batch_size, n_step, device):
+        """
+        Returns:
+            Tensor: boolean [batch_size, n_step], True where the ground truth is fed.
+        """
+        if self.mode == 'full':
+            return torch.ones((batch_size, n_step), dtype=torch.bool, device=device)
+        return torch.rand((batch_size, n_step), device=device) < self.eps
+
+    @staticmethod
+    def blend(mask, truth, sampled):
+        """
+        Args:
+            mask (Tensor): boolean [batch_size] decisions of the current step
+            truth (Tensor): ground truth tokens [batch_size, features]
+            sampled (Tensor): tokens sampled from the previous output [batch_size, features]
+        Returns:
+            Tensor: next input tokens.
+        """
+        return torch.where(mask.unsqueeze(1), truth.float(), sampled.float())
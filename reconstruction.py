@@ -22,12 +22,12 @@ def reconstruction(args, model, epoch, dataset):
     ind = 0
     for i, axi in enumerate(ax.flat):
         if i % 2 == 0:
-            piano_roll = dataset[rand_ind[ind]]
+            piano_roll = dataset.unpack(dataset[rand_ind[ind]])
             axi.matshow(piano_roll, alpha=1)
             # write row/col indices as axes' title for identification
             axi.set_title("Original number " + str(rand_ind[ind]))
         else:
-            cur_input = dataset[rand_ind[ind]].unsqueeze(0).to(args.device)
+            cur_input = dataset.unpack(dataset[rand_ind[ind]].to(args.device)).unsqueeze(0)
             x_reconstruct, _, _ = model(cur_input)
             x_reconstruct = x_reconstruct[0].detach().cpu()
             if args.num_classes > 1:
@@ -96,7 +96,7 @@ def sampling(args, model, fs=25, program=0):
 
 def interpolation(args, model, dataset, fs=25, program=0):
     x_a, x_b = dataset[random.randint(0, len(dataset) - 1)], dataset[random.randint(0, len(dataset) - 1)]
-    x_a, x_b = x_a.to(args.device), x_b.to(args.device)
+    x_a, x_b = dataset.unpack(x_a.to(args.device)), dataset.unpack(x_b.to(args.device))
     # Encode samples to the latent space
     z_a, z_b = model.encode(x_a.unsqueeze(0)), model.encode(x_b.unsqueeze(0))
     # Run through alpha values
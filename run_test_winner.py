@@ -51,6 +51,11 @@ perm = [[i, j, k, l, m] for i in data_augment
 
 run_name = 'run_' + str(args.device).replace(':', '_') + '.sh'
 with open(run_name, 'w') as file:
+    # Export all the swept variants in a single pass before the runs
+    cmd_str = 'python -m data_loaders.data_loader --midi_path ' + args.midi_path + ' --dataset ' + args.dataset
+    cmd_str += ' --export_frames ' + str(args.frame_bar) + ' --export_types ' + args.score_type
+    cmd_str += ' --export_sigs ' + ','.join(score_sig)
+    file.write(cmd_str + '\n')
     for r in range(args.m_runs):
         for vals in perm:
             cmd_str = 'python main.py --device ' + args.device
@@ -90,6 +95,12 @@ res = [[i, j, k, l] for i in dataset
 
 run_name = 'run_' + str(args.device).replace(':', '_') + '.sh'
 with open(run_name, 'w') as file:
+    # Export all the swept variants in a single pass before the runs
+    for d in dataset:
+        cmd_str = 'python -m data_loaders.data_loader --midi_path ' + args.midi_path + ' --dataset ' + d
+        cmd_str += ' --export_frames ' + ','.join([str(f) for f in frame_bar]) + ' --export_types ' + ','.join(phony)
+        cmd_str += ' --export_sigs ' + args.score_sig
+        file.write(cmd_str + '\n')
     for r in range(args.n_runs):
         for vals in res:
             cmd_str = 'python main.py --device ' + args.device
@@ -90,7 +90,7 @@ def compute_symbolic_features(loader, args):
         final_features[f] = []
     for x in loader:
         # Send to device
-        x = x.to(args.device, non_blocking=True)
+        x = loader.dataset.unpack(x.to(args.device, non_blocking=True))
         for x_cur in x:
             # Compute symbolic features on input
             feats = symbolic_features(x_cur, min_pitch=args.min_pitch)